@@ -1,2 +1,2 @@
-from .alta_ascent import AltaAscent
-__all__ = ['AltaAscent']
+from .alta_ascent import AltaAscent, load_driver
+__all__ = ['AltaAscent', 'load_driver']
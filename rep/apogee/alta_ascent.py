@@ -1,27 +1,35 @@
 import numpy as N
-try:
+
+from ..generic import Camera, CameraError
+from .. import trace
+
+# Set by load_driver(), so that importing this module is cheap and works even
+# if win32com isn't available
+win32com = None
+Constants = None
+
+
+def load_driver():
+    '''
+    Generate and import the Apogee ActiveX module. This is done when the
+    first AltaAscent is created; call it earlier to pay the cost up front.
+    '''
+    global win32com, Constants
+    if Constants is not None:
+        return
     import win32com.client
-    # generate and import apogee ActiveX module
     win32com.client.gencache.EnsureModule('{A2882C73-7CFB-11D4-9155-0060676644C1}', 0, 1, 0)
     from win32com.client import constants as Constants
-except ImportError:
-    # Create a fake module so that we can still build the documentation even if
-    # win32com isn't available
-    class _FakeModule:
-        def __getattr__(self, name):
-            raise ImportError("Couldn't import win32com.client")
-    win32com = _FakeModule()
-    Constants = _FakeModule()
-
-from ..generic import Camera, CameraError
 
 
 class AltaAscent(Camera):
     '''Apogee Alta or Ascent camera'''
 
     def __init__(self, interface='usb', *args, **kwargs):
+        load_driver()
         Camera.__init__(self, *args, **kwargs)
-        self._cam = win32com.client.Dispatch('Apogee.Camera2')
+        self._cam = trace.wrap(win32com.client.Dispatch('Apogee.Camera2'),
+            'AltaAscent')
         if interface == 'usb':
             self._interface = Constants.Apn_Interface_USB
         elif interface == 'net':
@@ -0,0 +1,161 @@
+import time
+import threading
+
+__all__ = ['Future', 'TimeoutError', 'CancelledError', 'wait_all',
+    'run_in_thread']
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class CancelledError(Exception):
+    pass
+
+
+class Future(object):
+    """
+    The result of an operation that an instrument is carrying out in the
+    background, such as a stage move. Modeled after concurrent.futures.Future,
+    which isn't available in Python 2.
+    """
+
+    def __init__(self, cancel_callback=None):
+        """
+        @cancel_callback: function that is called by cancel() to stop the
+        operation; it may complete the future itself, for example when the
+        instrument confirms that it stopped
+        """
+        self._condition = threading.Condition()
+        self._done = False
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._cancel_callback = cancel_callback
+
+    def _finish(self, result=None, exception=None, cancelled=False):
+        with self._condition:
+            if self._done:
+                return False
+            self._result = result
+            self._exception = exception
+            self._cancelled = cancelled
+            self._done = True
+            self._condition.notify_all()
+        for callback in self._callbacks:
+            callback(self)
+        return True
+
+    def set_result(self, result):
+        return self._finish(result=result)
+
+    def set_exception(self, exception):
+        return self._finish(exception=exception)
+
+    def set_cancelled(self):
+        return self._finish(cancelled=True)
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        '''
+        Stop the operation. Returns False if it had already finished.
+        '''
+        if self._done:
+            return False
+        if self._cancel_callback is not None:
+            self._cancel_callback()
+        self.set_cancelled()
+        return True
+
+    def add_done_callback(self, callback):
+        '''
+        Call @callback with the future as its argument when the future
+        finishes, or immediately if it already has.
+        '''
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        '''
+        Wait until the future finishes, for at most @timeout seconds. Returns
+        whether it finished.
+        '''
+        with self._condition:
+            if timeout is None:
+                while not self._done:
+                    # Condition.wait() without a timeout can't be interrupted
+                    # with Ctrl+C in Python 2
+                    self._condition.wait(1.0)
+            else:
+                deadline = time.time() + timeout
+                while not self._done:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            return self._done
+
+    def result(self, timeout=None):
+        '''
+        Wait for the operation to finish and return its result. Raises the
+        operation's exception if it failed, CancelledError if it was cancelled,
+        or TimeoutError if it didn't finish within @timeout seconds.
+        '''
+        if not self.wait(timeout):
+            raise TimeoutError('Operation did not finish within '
+                '{} s'.format(timeout))
+        if self._cancelled:
+            raise CancelledError('Operation was cancelled')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutError('Operation did not finish within '
+                '{} s'.format(timeout))
+        return self._exception
+
+
+def wait_all(futures, timeout=None):
+    '''
+    Wait for all @futures to finish, for at most @timeout seconds in total,
+    and return a list of their results.
+    '''
+    deadline = None if timeout is None else time.time() + timeout
+    results = []
+    for future in futures:
+        if deadline is None:
+            results.append(future.result())
+        else:
+            results.append(future.result(max(0.0, deadline - time.time())))
+    return results
+
+
+def run_in_thread(func, *args, **kwargs):
+    '''
+    Call @func with the given arguments in a new background thread, and
+    return a Future for its return value.
+    '''
+    future = Future()
+
+    def run():
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
@@ -1,4 +1,9 @@
 from .camera import Camera, CameraError
+from .camera_group import CameraGroup, FrameSet
+from .frame_ring import FrameRingWriter, FrameRingReader
 from .direct_show_webcam import DirectShowWebcam
 from .opencv_webcam import OpenCVWebcam
-__all__ = ['Camera', 'CameraError', 'DirectShowWebcam', 'OpenCVWebcam']
+from .simulated_camera import SimulatedCamera
+__all__ = ['Camera', 'CameraError', 'CameraGroup', 'FrameSet',
+    'FrameRingWriter', 'FrameRingReader', 'DirectShowWebcam', 'OpenCVWebcam',
+    'SimulatedCamera']
@@ -1,3 +1,6 @@
+from .frame_ring import FrameRingWriter
+
+
 class CameraError(Exception):
     def __init__(self, msg, cam):
         self.msg = msg
@@ -10,6 +13,7 @@ class CameraError(Exception):
 class Camera(object):
     def __init__(self, cam=-1):
         self.camera_number = cam
+        self._publisher = None
         self.frame = None
 
     def __enter__(self):
@@ -29,6 +33,32 @@ class Camera(object):
     def query_frame(self):
         raise NotImplementedError()
 
+    @property
+    def frame(self):
+        '''The most recently captured frame, as a NumPy array.'''
+        return self._frame
+
+    @frame.setter
+    def frame(self, value):
+        self._frame = value
+        if self._publisher is not None and value is not None:
+            self._publisher.publish(value)
+
+    def start_publishing(self, name, n_slots=8, max_frame_bytes=None):
+        """
+        Publish every captured frame into a shared-memory ring buffer called
+        @name, from which other processes on this machine can read the frames
+        with FrameRingReader. See FrameRingWriter for the other parameters.
+        """
+        self.stop_publishing()
+        self._publisher = FrameRingWriter(name, n_slots, max_frame_bytes)
+
+    def stop_publishing(self):
+        '''Stop publishing frames and remove the shared-memory ring buffer.'''
+        if self._publisher is not None:
+            self._publisher.close()
+            self._publisher = None
+
     @property
     def id_string(self):
         raise NotImplementedError()
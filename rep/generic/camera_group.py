@@ -0,0 +1,155 @@
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+
+from .camera import CameraError
+
+
+class FrameSet(object):
+    '''
+    Frames captured simultaneously by the cameras in a CameraGroup. The
+    frames and timestamps are lists in the same order as the cameras.
+    '''
+
+    def __init__(self, frames, start_times, end_times):
+        self.frames = frames
+        self.start_times = start_times
+        self.end_times = end_times
+
+    @property
+    def timestamp(self):
+        '''Time at which the first camera was triggered'''
+        return min(self.start_times)
+
+    @property
+    def skew(self):
+        '''
+        Time between triggering the first and the last camera, in seconds.
+        '''
+        return max(self.start_times) - min(self.start_times)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+
+class _Barrier(object):
+    '''
+    Lets threads wait until @parties of them have arrived, then releases them
+    all at once. Used once; Python 2 has no threading.Barrier.
+    '''
+
+    def __init__(self, parties):
+        self._parties = parties
+        self._arrived = 0
+        self._condition = threading.Condition()
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the other threads, for at most @timeout seconds. Returns
+        whether all of them arrived.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            self._arrived += 1
+            if self._arrived == self._parties:
+                self._condition.notify_all()
+            while self._arrived < self._parties:
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+
+class CameraGroup(object):
+    '''
+    Captures frames from several cameras at once. Each camera gets its own
+    worker thread, and all workers are released at the same moment, so the
+    exposures overlap instead of following each other.
+    '''
+
+    def __init__(self, cameras, tolerance=None):
+        """
+        @cameras: list of Camera objects
+        @tolerance: maximum skew in seconds between the cameras for a frame set
+        to be accepted by capture(), or None to accept all frame sets
+        """
+        self.cameras = list(cameras)
+        self.tolerance = tolerance
+        self.n_dropped = 0
+        self._pool = None
+
+    def open(self):
+        for cam in self.cameras:
+            cam.open()
+        # One thread per camera, otherwise they can't all wait at the barrier
+        self._pool = ThreadPool(len(self.cameras))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for cam in self.cameras:
+            cam.close()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False  # don't suppress exceptions
+
+    @staticmethod
+    def _capture(cam, barrier, timeout):
+        if not barrier.wait(timeout):
+            raise CameraError('Other cameras not ready within {0} s'.format(
+                timeout), cam.camera_number)
+        start = time.time()
+        cam.query_frame()
+        return cam.frame, start, time.time()
+
+    def query_frames(self, timeout=None):
+        '''
+        Trigger all cameras at once and return a FrameSet with their frames
+        and timestamps. Exceptions raised by a camera are re-raised here.
+        @timeout: maximum time in seconds to wait for each camera
+        '''
+        # Released only when every worker has taken its task
+        barrier = _Barrier(len(self.cameras))
+        results = [self._pool.apply_async(self._capture,
+            (cam, barrier, timeout)) for cam in self.cameras]
+        frames, start_times, end_times = zip(*[result.get(timeout)
+            for result in results])
+        return FrameSet(list(frames), list(start_times), list(end_times))
+
+    def capture(self, n_sets, max_attempts=None, timeout=None):
+        '''
+        Capture @n_sets frame sets whose skew is within the tolerance. Frame
+        sets that are outside the tolerance are dropped and counted in the
+        n_dropped attribute. If @max_attempts is given, stop after that many
+        tries even if fewer than @n_sets sets were accepted.
+        Returns a list of FrameSets.
+        '''
+        accepted = []
+        attempts = 0
+        while len(accepted) < n_sets:
+            if max_attempts is not None and attempts >= max_attempts:
+                break
+            attempts += 1
+            frame_set = self.query_frames(timeout)
+            if self.tolerance is not None and frame_set.skew > self.tolerance:
+                self.n_dropped += 1
+                continue
+            accepted.append(frame_set)
+        return accepted
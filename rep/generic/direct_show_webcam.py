@@ -1,21 +1,23 @@
 import numpy as N
-try:
-    import VideoCapture
-except ImportError:
-    # Create a fake module so that we can still build the documentation even if
-    # VideoCapture isn't available
-    class _FakeModule:
-        def __getattr__(self, name):
-            raise ImportError("Couldn't import VideoCapture")
-    VideoCapture = _FakeModule()
 
 from ..generic import Camera, CameraError
 
+# Imported when the first webcam is created, so that importing this module
+# is cheap and works even if VideoCapture isn't available
+VideoCapture = None
+
+
+def _load_driver():
+    global VideoCapture
+    if VideoCapture is None:
+        import VideoCapture
+
 
 class DirectShowWebcam(Camera):
     '''Camera that interfaces through DirectShow'''
 
     def __init__(self, *args, **kwargs):
+        _load_driver()
         Camera.__init__(self, *args, **kwargs)
         self._cam = None
         self._width, self._height = (640, 480)  # Uneducated guess
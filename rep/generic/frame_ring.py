@@ -0,0 +1,250 @@
+import os
+import sys
+import mmap
+import time
+import struct
+import tempfile
+import numpy as N
+
+__all__ = ['FrameRingWriter', 'FrameRingReader']
+
+# Layout of the shared memory:
+# header (64 bytes): magic, number of slots, data capacity of each slot,
+#     sequence number of the most recently completed frame
+# n_slots times:
+#     slot header (64 bytes): begin sequence number, end sequence number,
+#         timestamp, dtype string, number of dimensions, shape (up to 4)
+#     frame data, padded to a multiple of 64 bytes
+#
+# The writer never waits for readers. Before it overwrites a slot it stores the
+# new sequence number in the slot's begin field, and after it has finished it
+# stores the same number in the end field. A reader that sees the number it
+# expects in the end field before looking at the data, and still in the begin
+# field afterwards, knows that the data was not touched in the meantime.
+_MAGIC = 'REPRING1'
+_HEADER = struct.Struct('<8sIIQ')
+_LATEST_OFFSET = 16
+_SLOT_HEADER = struct.Struct('<QQd8sI4I')
+_META_OFFSET = 16
+_MAX_DIMS = 4
+_ALIGN = 64
+
+
+def _round_up(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _path(name):
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(shm_dir, 'rep-frames-' + name)
+
+
+class FrameRingWriter(object):
+    '''
+    Publishes frames into a named shared-memory ring buffer, from which other
+    processes on the same machine can read them with FrameRingReader.
+    '''
+
+    def __init__(self, name, n_slots=8, max_frame_bytes=None):
+        """
+        @name: name of the ring buffer; readers open it by this name
+        @n_slots: number of frames kept in the ring
+        @max_frame_bytes: size of the largest frame that can be published; if
+        None, the ring is created at the first publish() call and sized to fit
+        that frame
+        """
+        self.name = name
+        self.n_slots = n_slots
+        self._mmap = None
+        self._file = None
+        self._seq = 0
+        if max_frame_bytes is not None:
+            self._create(max_frame_bytes)
+
+    def _create(self, max_frame_bytes):
+        self._capacity = _round_up(max_frame_bytes)
+        self._stride = _ALIGN + self._capacity
+        size = _ALIGN + self.n_slots * self._stride
+        if sys.platform == 'win32':
+            self._mmap = mmap.mmap(-1, size, tagname='rep-frames-' + self.name)
+        else:
+            self._file = open(_path(self.name), 'w+b')
+            self._file.truncate(size)
+            self._mmap = mmap.mmap(self._file.fileno(), size)
+        _HEADER.pack_into(self._mmap, 0, _MAGIC, self.n_slots, self._capacity,
+            0)
+
+    def publish(self, frame, timestamp=None):
+        '''
+        Copy @frame (a NumPy array) into the next slot of the ring. Returns the
+        sequence number of the frame; sequence numbers start at 1.
+        '''
+        if frame.ndim > _MAX_DIMS:
+            raise ValueError('Frames can have at most {} '
+                'dimensions'.format(_MAX_DIMS))
+        if self._mmap is None:
+            self._create(frame.nbytes)
+        if frame.nbytes > self._capacity:
+            raise ValueError('Frame of {} bytes does not fit in ring buffer '
+                'slot of {} bytes'.format(frame.nbytes, self._capacity))
+        if timestamp is None:
+            timestamp = time.time()
+
+        seq = self._seq + 1
+        offset = _ALIGN + (seq % self.n_slots) * self._stride
+        shape = tuple(frame.shape) + (0,) * (_MAX_DIMS - frame.ndim)
+        struct.pack_into('<Q', self._mmap, offset, seq)  # begin
+        struct.pack_into('<d8sI4I', self._mmap, offset + _META_OFFSET,
+            timestamp, frame.dtype.str, frame.ndim, *shape)
+        dest = N.ndarray(frame.shape, frame.dtype, buffer=self._mmap,
+            offset=offset + _ALIGN)
+        dest[...] = frame
+        struct.pack_into('<Q', self._mmap, offset + 8, seq)  # end
+        struct.pack_into('<Q', self._mmap, _LATEST_OFFSET, seq)
+        self._seq = seq
+        return seq
+
+    def close(self, unlink=True):
+        '''
+        Unmap the ring buffer. If @unlink is True, also remove its name, so
+        that no new readers can attach; readers that are already attached keep
+        their mapping.
+        '''
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            if unlink:
+                os.unlink(_path(self.name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False  # don't suppress exceptions
+
+
+class FrameRingReader(object):
+    '''
+    Maps a ring buffer created by FrameRingWriter read-only. Frames are
+    returned as NumPy arrays that point directly into the shared memory, so
+    they are only valid until the writer overwrites their slot; check with
+    is_valid() after using the data, or use copy() to get a private copy.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self._mmap = None
+        self._file = None
+
+    def open(self):
+        if sys.platform == 'win32':
+            header = mmap.mmap(-1, _ALIGN, tagname='rep-frames-' + self.name,
+                access=mmap.ACCESS_READ)
+            magic, self.n_slots, capacity, _ = _HEADER.unpack_from(header, 0)
+            header.close()
+            size = _ALIGN + self.n_slots * (_ALIGN + capacity)
+            self._mmap = mmap.mmap(-1, size, tagname='rep-frames-' + self.name,
+                access=mmap.ACCESS_READ)
+        else:
+            self._file = open(_path(self.name), 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0,
+                access=mmap.ACCESS_READ)
+            magic, self.n_slots, capacity, _ = _HEADER.unpack_from(self._mmap,
+                0)
+        if magic != _MAGIC:
+            self.close()
+            raise IOError('{} is not a frame ring buffer'.format(self.name))
+        self._stride = _ALIGN + capacity
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False  # don't suppress exceptions
+
+    @property
+    def latest_sequence(self):
+        '''Sequence number of the most recently published frame (0 if none)'''
+        return struct.unpack_from('<Q', self._mmap, _LATEST_OFFSET)[0]
+
+    def _slot_offset(self, seq):
+        return _ALIGN + (seq % self.n_slots) * self._stride
+
+    def get(self, seq=None):
+        '''
+        Get the frame with sequence number @seq, or the latest frame if @seq
+        is None. Returns a tuple (seq, timestamp, frame), where frame is a
+        read-only view on the shared memory, or None if the frame is not
+        available (not published yet or already overwritten).
+        '''
+        latest = self.latest_sequence
+        if seq is None:
+            seq = latest
+        if seq <= 0 or seq > latest or seq <= latest - self.n_slots:
+            return None
+
+        offset = self._slot_offset(seq)
+        (_, end, timestamp, dtype, ndim,
+            s0, s1, s2, s3) = _SLOT_HEADER.unpack_from(self._mmap, offset)
+        if end != seq:
+            return None
+        shape = (s0, s1, s2, s3)[:ndim]
+        count = 1
+        for dim in shape:
+            count *= dim
+        frame = N.frombuffer(self._mmap, dtype=N.dtype(dtype.rstrip('\0')),
+            count=count, offset=offset + _ALIGN).reshape(shape)
+        if not self.is_valid(seq):
+            return None
+        return seq, timestamp, frame
+
+    def is_valid(self, seq):
+        '''
+        Whether the slot holding frame @seq has not been overwritten yet.
+        Call this after processing a frame returned by get() to check that the
+        data did not change underneath you.
+        '''
+        offset = self._slot_offset(seq)
+        return struct.unpack_from('<Q', self._mmap, offset)[0] == seq
+
+    def copy(self, seq=None):
+        '''
+        Like get(), but returns a private copy of the frame, which remains
+        valid after the writer overwrites the slot.
+        '''
+        result = self.get(seq)
+        if result is None:
+            return None
+        seq, timestamp, frame = result
+        frame = frame.copy()
+        if not self.is_valid(seq):
+            return None
+        return seq, timestamp, frame
+
+    def wait_for_frame(self, after_seq=0, timeout=None, poll_interval=1e-3):
+        '''
+        Wait until a frame newer than @after_seq has been published, and
+        return its sequence number, or None if @timeout seconds elapse first.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            latest = self.latest_sequence
+            if latest > after_seq:
+                return latest
+            if deadline is not None and time.time() > deadline:
+                return None
+            time.sleep(poll_interval)
@@ -1,18 +1,20 @@
-try:
-    import cv
-    from cv import CV_CAP_PROP_FRAME_WIDTH as FRAME_WIDTH
-    from cv import CV_CAP_PROP_FRAME_HEIGHT as FRAME_HEIGHT
-except ImportError:
-    # Create a fake module so that we can still build the documentation even if
-    # OpenCV isn't available
-    class _FakeModule:
-        def __getattr__(self, name):
-            raise ImportError("Couldn't import cv")
-    cv = _FakeModule()
 import numpy as N
 
 from ..generic import Camera, CameraError
 
+# Imported when the first webcam is created, so that importing this module
+# is cheap and works even if OpenCV isn't available
+cv = None
+FRAME_WIDTH = FRAME_HEIGHT = None
+
+
+def _load_driver():
+    global cv, FRAME_WIDTH, FRAME_HEIGHT
+    if cv is None:
+        import cv
+        FRAME_WIDTH = cv.CV_CAP_PROP_FRAME_WIDTH
+        FRAME_HEIGHT = cv.CV_CAP_PROP_FRAME_HEIGHT
+
 
 def ipl2array(im):
     '''Converts an IplImage @im to a NumPy array.
@@ -36,6 +38,7 @@ def ipl2array(im):
 
 class OpenCVWebcam(Camera):
     def __init__(self, *args, **kwargs):
+        _load_driver()
         Camera.__init__(self, *args, **kwargs)
         self._capture = None
 
@@ -0,0 +1,136 @@
+import time
+import numpy as N
+
+from ..generic import Camera, CameraError
+
+
+class SimulatedCamera(Camera):
+    '''
+    Camera that generates synthetic frames: a flat background with Gaussian
+    spots and Gaussian noise on top. It needs no hardware or drivers, so it can
+    be used to test and benchmark frame processing code on any machine.
+    '''
+
+    def __init__(self, resolution=(640, 480), dtype=N.uint16, n_spots=5,
+        spot_width=10.0, background=0.1, noise=0.02, exposure_time=0.0,
+        frame_rate=None, seed=None, *args, **kwargs):
+        """
+        @resolution: (width, height) of the simulated sensor in pixels
+        @dtype: NumPy data type of the frames
+        @n_spots: number of Gaussian spots in the image
+        @spot_width: standard deviation of the spots in pixels
+        @background: background level, as a fraction of full scale
+        @noise: standard deviation of the noise, as a fraction of full scale
+        @exposure_time: time in seconds that query_frame() takes to return
+        @frame_rate: maximum number of frames per second, or None for no limit
+        @seed: seed for the random number generator, to get reproducible frames
+        """
+        Camera.__init__(self, *args, **kwargs)
+        self._width, self._height = resolution
+        self._dtype = N.dtype(dtype)
+        self._n_spots = n_spots
+        self._spot_width = spot_width
+        self._background = background
+        self._noise = noise
+        self.exposure_time = exposure_time
+        self.frame_rate = frame_rate
+        self._seed = seed
+
+        self._roi = (0, 0, self._width, self._height)
+        self._rng = None
+        self._spots = None
+        self._pattern = None
+        self._last_exposure_start = None
+
+    def open(self):
+        self._rng = N.random.RandomState(self._seed)
+        self._make_spots()
+        self._make_pattern()
+        self._last_exposure_start = None
+
+    def close(self):
+        self._rng = None
+        self._spots = None
+        self._pattern = None
+
+    def _full_scale(self):
+        if self._dtype.kind in 'ui':
+            return float(N.iinfo(self._dtype).max)
+        return 1.0
+
+    def _make_spots(self):
+        # Spot positions are in sensor coordinates, so that they stay in place
+        # when the ROI changes
+        full_scale = self._full_scale()
+        self._spots = zip(
+            self._rng.uniform(0, self._width, self._n_spots),
+            self._rng.uniform(0, self._height, self._n_spots),
+            self._rng.uniform(0.3, 0.8, self._n_spots) * full_scale)
+
+    def _make_pattern(self):
+        '''Precompute the noiseless image inside the ROI'''
+        x0, y0, w, h = self._roi
+        y, x = N.ogrid[y0:y0 + h, x0:x0 + w]
+        pattern = N.empty((h, w))
+        pattern.fill(self._background * self._full_scale())
+        two_sigma_sq = 2.0 * self._spot_width ** 2
+        for cx, cy, amplitude in self._spots:
+            pattern += amplitude * N.exp(
+                -((x - cx) ** 2 + (y - cy) ** 2) / two_sigma_sq)
+        self._pattern = pattern
+
+    def _wait_for_exposure(self):
+        '''
+        Sleep for the exposure time, after first waiting for the next frame
+        slot if the frame rate is limited.
+        '''
+        now = time.time()
+        start = now
+        if self.frame_rate and self._last_exposure_start is not None:
+            start = max(now, self._last_exposure_start + 1.0 / self.frame_rate)
+        self._last_exposure_start = start
+        delay = start + self.exposure_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def query_frame(self):
+        if self._pattern is None:
+            raise CameraError('Camera is not open', self.camera_number)
+        self._wait_for_exposure()
+
+        frame = self._rng.standard_normal(self._pattern.shape)
+        frame *= self._noise * self._full_scale()
+        frame += self._pattern
+        if self._dtype.kind in 'ui':
+            N.clip(frame, 0, self._full_scale(), out=frame)
+        self.frame = frame.astype(self._dtype)
+
+    @property
+    def id_string(self):
+        return 'Simulated camera {}x{} {} (no driver)'.format(self._width,
+            self._height, self._dtype.name)
+
+    @property
+    def resolution(self):
+        return (self._width, self._height)
+
+    @resolution.setter
+    def resolution(self, value):
+        self._width, self._height = value
+        # Changing the resolution resets the ROI to the full sensor
+        self.roi = (0, 0, self._width, self._height)
+
+    @property
+    def roi(self):
+        return self._roi
+
+    @roi.setter
+    def roi(self, value):
+        x, y, w, h = value
+        if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > self._width or \
+            y + h > self._height:
+            raise CameraError('ROI {} outside sensor area {}x{}'.format(value,
+                self._width, self._height), self.camera_number)
+        self._roi = (x, y, w, h)
+        if self._spots is not None:
+            self._make_pattern()
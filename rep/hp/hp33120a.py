@@ -1,12 +1,41 @@
+import time
+import numpy as N
 import visa
 
-__all__ = ['HP33120A']
+__all__ = ['HP33120A', 'volts_to_dac']
+
+# Arbitrary waveforms are 12-bit, from -2047 to +2047, and 8 to 16000 points
+_DAC_MAX = 2047
+_MIN_POINTS = 8
+_MAX_POINTS = 16000
+# Smallest amplitude the generator accepts, 50 mVpp, in the units of
+# volts_to_dac() (twice the programmed value, see set_dc_voltage())
+_MIN_AMPLITUDE = 0.1
+
+
+def volts_to_dac(volts, min_amplitude=0.0):
+    """
+    Convert an array of @volts into DAC codes for an arbitrary waveform.
+    Returns the codes as int16, and the amplitude (peak-to-peak) and offset in
+    volts that make the waveform come out at those voltages. Waveforms that
+    span less than @min_amplitude use only part of the DAC range, so that
+    they come out right at an amplitude of @min_amplitude.
+    """
+    volts = N.asarray(volts, dtype=float)
+    low, high = volts.min(), volts.max()
+    offset = (high + low) / 2.0
+    amplitude = max(high - low, min_amplitude)
+    if amplitude == 0:
+        return N.zeros(len(volts), N.int16), 0.0, offset
+    codes = N.rint((volts - offset) * (2.0 * _DAC_MAX / amplitude))
+    return codes.astype(N.int16), amplitude, offset
 
 
 class HP33120A(visa.GpibInstrument):
     """HP 33120A 15 MHz function and arbitrary waveform generator"""
     def __init__(self, *args, **kwargs):
         super(HP33120A, self).__init__(*args, **kwargs)
+        self._settings = {}  # last command sent for each setting
 
     @property
     def id_string(self):
@@ -19,13 +48,92 @@ class HP33120A(visa.GpibInstrument):
     def __exit__(self, type, value, traceback):
         pass
 
+    def _write_setting(self, setting, command):
+        """
+        Write @command, unless it was the last command written for @setting.
+        """
+        if self._settings.get(setting) == command:
+            return
+        self.write(command)
+        self._settings[setting] = command
+
+    def invalidate_settings(self):
+        """
+        Forget which settings were written. Call this when the settings may
+        have been changed on the front panel.
+        """
+        self._settings.clear()
+
     def set_dc_voltage(self, voltage):
         """
         Set the function generator to output a DC voltage. Specify the @voltage
-        parameter in volts.
+        parameter in volts. Nothing is sent if the voltage is already set.
         """
         # Must divide by 2, because the offset is in peak-to-peak volts?!
-        self.write('APPL:DC DEF,DEF,{:f}'.format(voltage / 2.0))
+        command = 'APPL:DC DEF,DEF,{:f}'.format(voltage / 2.0)
+        if self._settings.get('output') == command:
+            return
+        self.invalidate_settings()  # APPL resets the other settings
+        self._write_setting('output', command)
+
+    def upload_waveform(self, volts):
+        """
+        Upload the NumPy array @volts (8 to 16000 points) as the arbitrary
+        waveform in volatile memory, in one binary DATA:DAC transfer. Returns
+        the amplitude and offset that reproduce the voltages, see
+        volts_to_dac(); at least the generator's minimum amplitude.
+        """
+        if not _MIN_POINTS <= len(volts) <= _MAX_POINTS:
+            raise ValueError('Arbitrary waveforms have {} to {} points'.format(
+                _MIN_POINTS, _MAX_POINTS))
+        codes, amplitude, offset = volts_to_dac(volts, _MIN_AMPLITUDE)
+        self._write_setting('byte order', 'FORM:BORD NORM')
+        data = codes.astype('>i2').tostring()
+        length = str(len(data))
+        self.write('DATA:DAC VOLATILE,#{}{}{}'.format(len(length), length,
+            data))
+        self._settings.pop('output', None)
+        return amplitude, offset
+
+    def play_waveform(self, volts, frequency):
+        """
+        Upload @volts as arbitrary waveform and output it repeatedly at
+        @frequency (in Hz) periods per second.
+        """
+        amplitude, offset = self.upload_waveform(volts)
+        self._write_setting('output', 'FUNC:USER VOLATILE;:FUNC:SHAP USER')
+        self._write_setting('frequency', 'FREQ {:f}'.format(frequency))
+        # Divide by 2 for the same reason as in set_dc_voltage()
+        self._write_setting('amplitude', 'VOLT {:f}'.format(amplitude / 2.0))
+        self._write_setting('offset', 'VOLT:OFFS {:f}'.format(offset / 2.0))
+
+    def sweep(self, voltages, step_time):
+        """
+        Step through the list of @voltages, holding each one for @step_time
+        seconds, timed by the function generator. The sweep is uploaded as an
+        arbitrary waveform, with each voltage repeated as often as fits, and
+        repeats until the output is changed.
+        """
+        voltages = N.asarray(voltages, dtype=float)
+        repeats = max(1, _MAX_POINTS // len(voltages))
+        if len(voltages) * repeats < _MIN_POINTS:
+            raise ValueError('Too few voltages')
+        self.play_waveform(N.repeat(voltages, repeats),
+            1.0 / (len(voltages) * step_time))
+
+    def step_dc_voltage(self, voltages, interval):
+        """
+        Step the DC output through the list of @voltages, one every @interval
+        seconds, timed by the computer. Voltages that are the same as the
+        previous one are not sent. Use sweep() for shorter intervals.
+        """
+        next_time = time.time()
+        for voltage in voltages:
+            self.set_dc_voltage(voltage)
+            next_time += interval
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
 
 if __name__ == '__main__':
     dev = HP33120A(10)
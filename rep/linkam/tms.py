@@ -1,37 +1,248 @@
+import time
+import threading
+import numpy as N
 import visa
+import pyvisa.visa_exceptions
 
-__all__ = ['TempStage', 'TMS91', 'TMS94']
+from ..futures import Future, TimeoutError
+
+__all__ = ['TemperatureLog', 'TempStage', 'TMS91', 'TMS94']
 
 # Original code kindly contributed by Filip Dominec <dominecf@fzu.cz>
 # See http://www.fzu.cz/~dominecf/python/FDLabInstruments.py
 
 
+class TemperatureLog(object):
+    """
+    Ring buffer of timestamped temperatures and status bytes, filled by a
+    TempStage's logging thread. Timestamps are the host's time.time() when
+    the reply arrived.
+    """
+
+    def __init__(self, capacity=100000):
+        self._times = N.zeros(capacity)
+        self._temps = N.zeros(capacity)
+        self._statuses = N.zeros(capacity, dtype=N.uint8)
+        self._count = 0
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+    def __len__(self):
+        return min(self._count, len(self._times))
+
+    def append(self, timestamp, temp, status):
+        with self._lock:
+            index = self._count % len(self._times)
+            self._times[index] = timestamp
+            self._temps[index] = temp
+            self._statuses[index] = status
+            self._count += 1
+            self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the next entry, for at most @timeout seconds. Returns whether
+        an entry arrived.
+        '''
+        with self._condition:
+            count = self._count
+            self._condition.wait(timeout)
+            return self._count != count
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+
+    def latest(self):
+        '''
+        The most recent (timestamp, temperature, status) tuple, or None if
+        nothing was logged yet. Never waits for the stage.
+        '''
+        with self._lock:
+            if self._count == 0:
+                return None
+            index = (self._count - 1) % len(self._times)
+            return (self._times[index], self._temps[index],
+                int(self._statuses[index]))
+
+    def snapshot(self):
+        '''
+        Returns copies of the stored timestamps, temperatures (in deg C) and
+        status bytes, oldest first.
+        '''
+        with self._lock:
+            capacity = len(self._times)
+            if self._count <= capacity:
+                return (self._times[:self._count].copy(),
+                    self._temps[:self._count].copy(),
+                    self._statuses[:self._count].copy())
+            start = self._count % capacity
+            return (N.roll(self._times, -start), N.roll(self._temps, -start),
+                N.roll(self._statuses, -start))
+
+    def window(self, duration):
+        '''
+        Returns the timestamps and temperatures of the entries logged in the
+        last @duration seconds before the latest entry, oldest first.
+        '''
+        times, temps, _ = self.snapshot()
+        if len(times) == 0:
+            return times, temps
+        first = N.searchsorted(times, times[-1] - duration)
+        return times[first:], temps[first:]
+
+    def is_settled(self, target, tolerance=0.5, max_slope=0.5, duration=30.0):
+        '''
+        Whether the temperature has settled at @target: during the last
+        @duration seconds, the temperature must have stayed within
+        @tolerance deg C of the target on average, with a standard deviation
+        of at most @tolerance and a fitted slope of at most @max_slope
+        deg C/min. Returns False if less than @duration seconds were logged.
+        '''
+        times, temps = self.window(duration)
+        if len(times) < 3 or times[-1] - times[0] < 0.9 * duration:
+            return False
+        slope = N.polyfit(times - times[0], temps, 1)[0] * 60.0
+        return (abs(temps.mean() - target) <= tolerance and
+            temps.std() <= tolerance and abs(slope) <= max_slope)
+
+
 class TempStage(object, visa.SerialInstrument):
     """Base class for Linkam temperature stages."""
 
     def __init__(self, *args, **kwargs):
+        self._io_lock = threading.RLock()
+        self._log = None
+        self._log_thread = None
+        self._log_stop = threading.Event()
+        self._log_error = None  # exception that stopped the logging thread
+        self._profile_stop = None
+        self._target = None
         visa.SerialInstrument.__init__(self, *args, **kwargs)
         self.term_chars = visa.CR
         self.rate = 20
 
+    # Number of ramp segments the controller can store
+    max_segments = 1
+
     # Dummy context manager
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        pass
+        self.stop_profile()
+        self.stop_logging()
+
+    # The logging thread and the caller share the serial port
+    def write(self, message):
+        with self._io_lock:
+            visa.SerialInstrument.write(self, message)
+
+    def ask(self, message):
+        with self._io_lock:
+            return visa.SerialInstrument.ask(self, message)
+
+    def _parse_temp(self, raw_string):
+        raise NotImplementedError
 
     @property
     def temp(self):
-        """Temperature in deg C"""
-        raise NotImplementedError
+        """Temperature in deg C. While logging, this is the latest logged
+        temperature, so it doesn't wait for the stage."""
+        self._check_log_error()
+        if self.logging:
+            latest = self._log.latest()
+            if latest is not None:
+                return latest[1]
+        return self._parse_temp(self.ask('T'))
+
+    @temp.setter
+    def temp(self, value):
+        self.program([(self.rate, value)])
 
     @property
     def status(self):
-        """Current status byte"""
+        """Current status byte. While logging, this is the latest logged
+        status."""
+        self._check_log_error()
+        if self.logging:
+            latest = self._log.latest()
+            if latest is not None:
+                return latest[2]
         raw_string = self.ask('T')
         return ord(raw_string[0])
 
+    @property
+    def log(self):
+        """TemperatureLog of the current or last logging run, or None"""
+        return self._log
+
+    @property
+    def logging(self):
+        return self._log_thread is not None and self._log_thread.is_alive()
+
+    def _check_log_error(self):
+        '''Raise the error that stopped the logging thread, if any.'''
+        if self._log_error is not None:
+            raise self._log_error
+
+    def start_logging(self, interval=0.1, capacity=100000, filename=None):
+        """
+        Poll the temperature and status every @interval seconds in a
+        background thread, into a new TemperatureLog of @capacity entries.
+        If @filename is given, every entry is also written to that file as a
+        line of tab-separated timestamp, temperature and status byte.
+        Replies that time out are skipped; any other error stops the thread,
+        and is raised again by temp, status and wait_until_settled().
+        """
+        self.stop_logging()
+        self._log = TemperatureLog(capacity)
+        self._log_stop.clear()
+        self._log_error = None
+        log_file = open(filename, 'a') if filename is not None else None
+        self._log_thread = threading.Thread(target=self._log_loop,
+            args=(interval, log_file))
+        self._log_thread.daemon = True
+        self._log_thread.start()
+
+    def stop_logging(self):
+        """Stop the logging thread; the log remains available."""
+        if self._log_thread is None:
+            return
+        self._log_stop.set()
+        self._log_thread.join()
+        self._log_thread = None
+        self._log_error = None
+
+    def _log_loop(self, interval, log_file):
+        next_time = time.time()
+        last_flush = next_time
+        try:
+            while not self._log_stop.is_set():
+                try:
+                    raw_string = self.ask('T')
+                    timestamp = time.time()
+                    temp = self._parse_temp(raw_string)
+                    status = ord(raw_string[0])
+                except (pyvisa.visa_exceptions.VisaIOError, ValueError, IndexError):
+                    pass
+                else:
+                    self._log.append(timestamp, temp, status)
+                    if log_file is not None:
+                        log_file.write('{0:.3f}\t{1}\t{2}\n'.format(timestamp,
+                            temp, status))
+                        if timestamp - last_flush > 1.0:
+                            log_file.flush()
+                            last_flush = timestamp
+                # Keep a fixed rate, but don't try to catch up after a stall
+                next_time = max(next_time + interval, time.time())
+                self._log_stop.wait(next_time - time.time())
+        except Exception as e:
+            self._log_error = e
+        finally:
+            if log_file is not None:
+                log_file.close()
+
     @property
     def rate(self):
         """Rate of temperature change (deg C/min); default is 20"""
@@ -41,6 +252,124 @@ class TempStage(object, visa.SerialInstrument):
     def rate(self, value):
         self._rate = abs(value)
 
+    @property
+    def target(self):
+        """Limit temperature of the last segment programmed, or None"""
+        return self._target
+
+    def _write_profile(self, segments):
+        raise NotImplementedError
+
+    def program(self, segments):
+        """
+        Upload @segments, a list of (rate, limit) pairs in deg C/min and deg
+        C, in one go and start the profile. The stage ramps through the
+        segments and holds the last limit. At most max_segments segments are
+        allowed.
+        """
+        segments = list(segments)
+        if not 0 < len(segments) <= self.max_segments:
+            raise ValueError('The controller stores at most {0} segments, '
+                'got {1}'.format(self.max_segments, len(segments)))
+        with self._io_lock:
+            self._write_profile(segments)
+            self.write('S')  # Starts action
+        self._target = segments[-1][1]
+
+    def wait_until_settled(self, target=None, timeout=None, tolerance=0.5,
+            max_slope=0.5, duration=30.0):
+        """
+        Wait until the temperature has settled at @target (default: the
+        target of the last profile programmed), as judged by
+        TemperatureLog.is_settled() with @tolerance, @max_slope and
+        @duration. Raises TimeoutError if it doesn't settle within @timeout
+        seconds. Starts logging if it isn't running already; any number of
+        threads can wait at the same time.
+        """
+        if target is None:
+            target = self._target
+        if target is None:
+            raise ValueError('No target temperature')
+        self._check_log_error()
+        if not self.logging:
+            self.start_logging()
+        log = self._log
+        deadline = None if timeout is None else time.time() + timeout
+        while not log.is_settled(target, tolerance, max_slope, duration):
+            self._check_log_error()
+            if deadline is None:
+                log.wait(1.0)
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError('Temperature did not settle at {0} deg C '
+                    'within {1} s'.format(target, timeout))
+            log.wait(min(remaining, 1.0))
+
+    def run_profile(self, segments, on_settled=None, **settle_options):
+        """
+        Run a multi-segment profile in a background thread. @segments is a
+        list of (rate, limit, hold) tuples: ramp at rate deg C/min to limit
+        deg C, wait until the temperature has settled there, and hold it for
+        hold seconds. Consecutive segments without hold are uploaded
+        together, as far as the controller can store them, and the stage
+        only needs to settle at the last of them. @on_settled is called with
+        the segment index and limit whenever the temperature has settled,
+        before holding. @settle_options are passed on to
+        wait_until_settled(). Returns a Future that finishes when the last
+        hold is over; cancelling it stops the profile at the current
+        segment.
+        """
+        self.stop_profile()
+        stop = threading.Event()
+        self._profile_stop = stop
+        future = Future(cancel_callback=stop.set)
+
+        # Group segments into uploads
+        uploads = []
+        upload = []
+        for index, (rate, limit, hold) in enumerate(segments):
+            upload.append((rate, limit))
+            if hold or len(upload) == self.max_segments or \
+                    index == len(segments) - 1:
+                uploads.append((index, upload, hold))
+                upload = []
+
+        def run():
+            try:
+                for index, upload, hold in uploads:
+                    if stop.is_set():
+                        return
+                    self.program(upload)
+                    while True:
+                        try:
+                            self.wait_until_settled(timeout=1.0,
+                                **settle_options)
+                            break
+                        except TimeoutError:
+                            if stop.is_set():
+                                return
+                    if on_settled is not None:
+                        on_settled(index, upload[-1][1])
+                    if stop.wait(hold):
+                        return
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(None)
+            finally:
+                # If the profile was stopped; does nothing if already finished
+                future.set_cancelled()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def stop_profile(self):
+        """Stop a profile started with run_profile() at its current segment"""
+        if self._profile_stop is not None:
+            self._profile_stop.set()
+            self._profile_stop = None
 
 class TMS91(TempStage):
     def __init__(self, *args, **kwargs):
@@ -52,17 +381,18 @@ class TMS91(TempStage):
         self.baud_rate = 9600
         self.timeout = 20
 
-    @property
-    def temp(self):
-        raw_string = self.ask('T')
+    def _parse_temp(self, raw_string):
         return float(raw_string[1:])
 
-    @temp.setter
-    def temp(self, value):
-        self.write('R1{:d}'.format(self.rate))  # Sets rate
-        self.write('L1{:d}'.format(value))  # Sets target temperature
-        self.write('R20')  # End of current profile
-        self.write('S')  # Starts action
+    # Segment numbers are a single digit, and one more is needed to end the
+    # profile
+    max_segments = 8
+
+    def _write_profile(self, segments):
+        for number, (rate, limit) in enumerate(segments, 1):
+            self.write('R{0}{1:d}'.format(number, int(rate)))  # Sets rate
+            self.write('L{0}{1:d}'.format(number, int(limit)))  # Sets limit
+        self.write('R{0}0'.format(len(segments) + 1))  # End of profile
 
 
 class TMS94(TempStage):
@@ -75,13 +405,10 @@ class TMS94(TempStage):
         self.baud_rate = 19200
         self.timeout = 3
 
-    @property
-    def temp(self):
-        raw_string = self.ask('T')
+    def _parse_temp(self, raw_string):
         return int(raw_string[6:10], 16) / 10.0
 
-    @temp.setter
-    def temp(self, value):
-        self.write('R1{:04d}'.format(self.rate * 100))  # Sets rate
-        self.write('L1{:04d}'.format(value * 10))  # Sets target temperature
-        self.write('S')  # Starts action
+    def _write_profile(self, segments):
+        (rate, limit), = segments
+        self.write('R1{:04d}'.format(int(round(rate * 100))))  # Sets rate
+        self.write('L1{:04d}'.format(int(round(limit * 10))))  # Sets limit
@@ -1,11 +1,16 @@
 from email.mime.text import MIMEText
+from email.header import Header
 import smtplib
 import socket
 import getpass
 import time
 import traceback
+import threading
+import Queue
 
-__all__ = ['send_email_done', 'send_email_crash']
+from .futures import Future
+
+__all__ = ['send_email_done', 'send_email_crash', 'Notifier']
 
 _done_string = '''
 Dear {recipient},
@@ -27,26 +32,66 @@ Sincerely,
 Your Friendly Measurement Robot
 '''
 
+_progress_string = '''
+Dear {recipient},
 
-def _send_email(from_name, from_addr, to_name, to_addr, subject, body,
-    smtp_server):
-    """Send an e-mail: generic"""
-    msg = MIMEText(body)
-    msg['Subject'] = subject
+Your measurement reported:
+
+{lines}
+
+Sincerely,
+Your Friendly Measurement Robot
+'''
+
+_from_name = 'Your Friendly Measurement Robot'
+_from_addr = None
+
+
+def _sender_address():
+    """
+    The robot's e-mail address. Looking up the host name can take seconds, so
+    it is done only once.
+    """
+    global _from_addr
+    if _from_addr is None:
+        _from_addr = getpass.getuser() + '@' + socket.getfqdn()
+    return _from_addr
+
+
+def _unicode(text):
+    '''@text as unicode; byte strings are taken to be UTF-8.'''
+    if isinstance(text, str):
+        return text.decode('utf-8', 'replace')
+    return unicode(text)
+
+
+def _format_email(from_name, from_addr, to_name, to_addr, subject, body):
+    msg = MIMEText(_unicode(body).encode('utf-8'), 'plain', 'utf-8')
+    subject = _unicode(subject)
+    try:
+        msg['Subject'] = subject.encode('ascii')
+    except UnicodeEncodeError:
+        msg['Subject'] = Header(subject, 'utf-8')
     msg['From'] = '{} <{}>'.format(from_name, from_addr)
     msg['To'] = '{} <{}>'.format(to_name, to_addr)
+    return msg.as_string()
+
 
+def _send_email(from_name, from_addr, to_name, to_addr, subject, body,
+    smtp_server):
+    """Send an e-mail: generic"""
     smtp = smtplib.SMTP(smtp_server)
-    smtp.sendmail(from_addr, to_addr, msg.as_string())
+    smtp.sendmail(from_addr, to_addr, _format_email(from_name, from_addr,
+        to_name, to_addr, subject, body))
     smtp.quit()
 
 
 def send_email_done(to_addr, to_name='Dr. Scientist', smtp_server='localhost'):
-    from_addr = getpass.getuser() + '@' + socket.getfqdn()
+    from_addr = _sender_address()
 
     body = _done_string.format(recipient=to_name, time=time.asctime())
     _send_email(
-        from_name='Your Friendly Measurement Robot',
+        from_name=_from_name,
         from_addr=from_addr,
         to_name=to_name,
         to_addr=to_addr,
@@ -57,12 +102,12 @@ def send_email_done(to_addr, to_name='Dr. Scientist', smtp_server='localhost'):
 
 def send_email_crash(to_addr, to_name='Dr. Scientist', smtp_server='localhost'):
     trace = traceback.format_exc()
-    from_addr = getpass.getuser() + '@' + socket.getfqdn()
+    from_addr = _sender_address()
 
     body = _crash_string.format(recipient=to_name, time=time.asctime(),
         trace=trace)
     _send_email(
-        from_name='Your Friendly Measurement Robot',
+        from_name=_from_name,
         from_addr=from_addr,
         to_name=to_name,
         to_addr=to_addr,
@@ -70,6 +115,227 @@ def send_email_crash(to_addr, to_name='Dr. Scientist', smtp_server='localhost'):
         body=body,
         smtp_server=smtp_server)
 
+
+_STOP = object()
+_FLUSH = object()
+
+
+class Notifier(object):
+    """
+    Sends e-mail notifications from a background thread, so that a slow
+    mail server never holds up the measurement. The SMTP connection is kept
+    open between messages and closed after @idle_timeout seconds without
+    messages. Failed messages are retried with exponential backoff. Progress
+    messages are collected and sent as one digest at most every
+    @digest_interval seconds.
+
+    To test without a real mail server, start a stand-in server, for example
+    with python -m smtpd -n -c DebuggingServer localhost:8025, and use
+    smtp_server='localhost:8025'.
+    """
+
+    def __init__(self, to_addr, to_name='Dr. Scientist',
+            smtp_server='localhost', digest_interval=600.0, max_retries=5,
+            retry_delay=1.0, idle_timeout=60.0):
+        """
+        @retry_delay: seconds to wait before the first retry; the wait is
+        doubled after every failed attempt
+        """
+        self.to_addr = to_addr
+        self.to_name = to_name
+        self.smtp_server = smtp_server
+        self.digest_interval = digest_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+
+        self._smtp = None
+        self._last_used = 0.0
+        self._queue = Queue.Queue()
+        self._digest = []  # (time, text) of progress messages not yet sent
+        self._digest_lock = threading.Lock()
+        self._last_digest = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def send(self, subject, body):
+        """
+        Queue an e-mail and return immediately. Returns a Future that
+        finishes when the e-mail is sent, or fails with the error of the last
+        attempt.
+        """
+        future = Future()
+        self._queue.put((subject, body, future))
+        return future
+
+    def done(self):
+        """Notify that the measurement finished."""
+        return self.send('Your measurement is done',
+            _done_string.format(recipient=self.to_name, time=time.asctime()))
+
+    def crash(self):
+        """
+        Notify that the measurement crashed. Call this in an except block;
+        the traceback is included in the e-mail.
+        """
+        return self.send('Your measurement crashed',
+            _crash_string.format(recipient=self.to_name, time=time.asctime(),
+            trace=traceback.format_exc()))
+
+    def progress(self, text):
+        """Add @text to the next progress digest."""
+        with self._digest_lock:
+            self._digest.append((time.time(), text))
+        self._queue.put(None)  # Wake up the sender
+
+    def flush(self, timeout=None):
+        """
+        Send the progress digest now, and wait for at most @timeout seconds
+        until all queued e-mails have been sent. Returns whether they have;
+        raises the error if the digest could not be sent.
+        """
+        future = Future()
+        self._queue.put((_FLUSH, None, future))
+        if not future.wait(timeout):
+            return False
+        future.result()
+        return True
+
+    def close(self, timeout=None):
+        """
+        Send the pending e-mails and the progress digest, and stop the
+        sender thread.
+        """
+        if not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        _sender_address()  # Look up the host name here, not in send()
+        while True:
+            try:
+                item = self._queue.get(timeout=self._time_until_due())
+            except Queue.Empty:
+                item = None
+            if item is _STOP:
+                break
+            if item is not None:
+                # An error fails only this item's future; the thread keeps
+                # sending the others
+                try:
+                    if item[0] is _FLUSH:
+                        self._send_digest(item[-1])
+                    else:
+                        self._deliver(*item)
+                except Exception as e:
+                    item[-1].set_exception(e)
+            if self._digest_due():
+                self._send_digest()
+            if self._smtp is not None and \
+                    time.time() - self._last_used > self.idle_timeout:
+                self._disconnect()
+        self._send_digest()
+        self._disconnect()
+
+    def _time_until_due(self):
+        '''How long the sender thread can sleep.'''
+        timeout = self.idle_timeout
+        with self._digest_lock:
+            if self._digest and self._last_digest is not None:
+                timeout = min(timeout, self._last_digest +
+                    self.digest_interval - time.time())
+        return max(timeout, 0.01)
+
+    def _digest_due(self):
+        with self._digest_lock:
+            return bool(self._digest) and (self._last_digest is None or
+                time.time() >= self._last_digest + self.digest_interval)
+
+    def _send_digest(self, future=None):
+        '''
+        Send the progress messages collected so far as one e-mail, and finish
+        @future when it has been sent or has failed.
+        '''
+        if future is None:
+            future = Future()
+        with self._digest_lock:
+            digest = self._digest
+            self._digest = []
+        if not digest:
+            future.set_result(None)
+            return
+        self._last_digest = time.time()
+        try:
+            lines = u'\n'.join(u'{}  {}'.format(time.ctime(timestamp),
+                _unicode(text)) for timestamp, text in digest)
+            body = _unicode(_progress_string).format(
+                recipient=_unicode(self.to_name), lines=lines)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self._deliver('Measurement progress', body, future)
+
+    def _connect(self):
+        if self._smtp is None:
+            self._smtp = smtplib.SMTP(self.smtp_server)
+        return self._smtp
+
+    def _disconnect(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+        self._smtp = None
+
+    def _deliver(self, subject, body, future):
+        '''
+        Send one e-mail, retrying on SMTP and network errors, and finish
+        @future. Any other error, such as a @body that can't be encoded,
+        fails @future right away.
+        '''
+        try:
+            message = _format_email(_from_name, _sender_address(),
+                self.to_name, self.to_addr, subject, body)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._connect().sendmail(_sender_address(), self.to_addr,
+                    message)
+            except (smtplib.SMTPException, socket.error) as e:
+                # Start over with a new connection next time
+                if self._smtp is not None:
+                    self._smtp.close()
+                    self._smtp = None
+                if attempt == self.max_retries:
+                    future.set_exception(e)
+                    return
+                time.sleep(delay)
+                delay *= 2
+            except Exception as e:
+                # The connection is in an unknown state
+                if self._smtp is not None:
+                    self._smtp.close()
+                    self._smtp = None
+                future.set_exception(e)
+                return
+            else:
+                self._last_used = time.time()
+                future.set_result(None)
+                return
+
 if __name__ == '__main__':
     send_email_done('chimento@physics.leidenuniv.nl',
         smtp_server='smtp.physics.leidenuniv.nl')
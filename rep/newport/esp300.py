@@ -1,21 +1,32 @@
+import time
+import threading
+import contextlib
+import numpy as N
 import visa
 import pyvisa.visa_exceptions
+from pyvisa import vpp43
 
-__all__ = ['ESP300Error', 'ESP300']
+from ..futures import TimeoutError
+
+__all__ = ['ESP300Error', 'ESP300', 'ESP300Axis']
 
 
 class ESP300Error(Exception):
-    def __init__(self, code, timestamp, message):
+    def __init__(self, code, timestamp, message, command=None):
         self.code = code
         self.timestamp = timestamp
         self.message = message
+        self.command = command
 
     def __str__(self):
+        if self.command is not None:
+            return 'Error {0}: {1} (command {2})'.format(self.code,
+                self.message, self.command)
         return 'Error {0}: {1}'.format(self.code, self.message)
 
 
-def _command(instrument, command, axis, value):
-    instrument.write('{0}{1}{2}'.format(axis, command, float(value)))
+def _command(command, axis, value):
+    return '{0}{1}{2}'.format(axis, command, float(value))
 
 
 class AxisProperty(object):
@@ -25,6 +36,8 @@ class AxisProperty(object):
         self._readonly = readonly
 
     def __getitem__(self, key):
+        # Make sure any batched commands have been carried out
+        self._instrument._flush_batch()
         try:
             values = self._instrument.ask_for_values('{0}{1}?'.format(key, self._command))
         except pyvisa.visa_exceptions.VisaIOError as e:
@@ -38,12 +51,12 @@ class AxisProperty(object):
     def __setitem__(self, key, value):
         if self._readonly:
             raise AttributeError('Read-only property')
-        _command(self._instrument, self._command, key, value)
-        self._instrument._check_error()
+        self._instrument._send(_command(self._command, key, value))
 
 
 class ESP300(visa.GpibInstrument, object):
     def __init__(self, *args, **kwargs):
+        self._io_lock = threading.RLock()
         visa.GpibInstrument.__init__(self, *args, **kwargs)
         # The defaults, but just make sure:
         self.term_chars = visa.CR + visa.LF
@@ -56,6 +69,10 @@ class ESP300(visa.GpibInstrument, object):
         # ACTUALLY, it crashes the GPIB, so don't do it! Thanks, Newport.
         # Another suggestion is to have a delay of 1-10 ms after each write.
         self.delay = 0.01
+        # Longest command line that the ESP300 accepts
+        self.max_line_length = 80
+        self._batch = None  # commands waiting to be sent
+        self._batch_sent = None  # commands sent in the current batch
 
         self.velocity = AxisProperty(self, 'VA')
         self.acceleration = AxisProperty(self, 'AC')
@@ -74,29 +91,228 @@ class ESP300(visa.GpibInstrument, object):
     def __exit__(self, type, value, traceback):
         pass
 
+    # Axes can be moved from several threads at once; keep each query
+    # together with its reply
+    def write(self, message):
+        with self._io_lock:
+            visa.GpibInstrument.write(self, message)
+
+    def ask(self, message):
+        with self._io_lock:
+            return visa.GpibInstrument.ask(self, message)
+
+    def ask_for_values(self, message, *args, **kwargs):
+        with self._io_lock:
+            return visa.GpibInstrument.ask_for_values(self, message, *args,
+                **kwargs)
+
     @property
     def id_string(self):
         return self.ask('*idn?')
 
-    def _check_error(self):
+    def axis(self, axis):
+        '''ESP300Axis object for axis number @axis.'''
+        return ESP300Axis(self, axis)
+
+    def _read_error(self):
         response = self.ask('TB?').split(',')
         try:
             code, timestamp, message = int(response[0]), int(response[1]), response[2]
-            if code != 0:
-                raise ESP300Error(code, timestamp, message)
         except ValueError:  # error code garbled
             raise ESP300Error(0, 0, 'An error occurred. '
                 'In addition, the error message was garbled.')
+        if code != 0:
+            return ESP300Error(code, timestamp, message)
+        return None
+
+    def _check_error(self):
+        error = self._read_error()
+        if error is not None:
+            raise error
+
+    def _send(self, command):
+        '''
+        Send @command and check for errors, or add it to the current batch.
+        '''
+        if self._batch is not None:
+            self._batch.append(command)
+            return
+        with self._io_lock:
+            self.write(command)
+            self._check_error()
+
+    def _join_lines(self, commands):
+        '''
+        Join @commands into as few command lines as the ESP300 accepts.
+        '''
+        lines = []
+        line = []
+        for command in commands:
+            if line and len(';'.join(line + [command])) > self.max_line_length:
+                lines.append(';'.join(line))
+                line = []
+            line.append(command)
+        if line:
+            lines.append(';'.join(line))
+        return lines
+
+    def _flush_batch(self):
+        '''
+        Send the commands of the current batch, joined into as few command
+        lines as possible.
+        '''
+        if not self._batch:
+            return
+        for line in self._join_lines(self._batch):
+            self.write(line)
+        self._batch_sent.extend(self._batch)
+        self._batch = []
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Context manager that collects the commands sent inside it, and sends
+        them together in as few command lines as possible when the block ends.
+        Errors are checked only once, at the end; if there was an error, the
+        ESP300Error names the command that most likely caused it. Queries
+        inside the block first send the commands collected so far.
+            with esp.batch():
+                for axis in (1, 2, 3):
+                    esp.velocity[axis] = 5.0
+                    esp.acceleration[axis] = 20.0
+        '''
+        if self._batch is not None:
+            yield self  # nested batch: part of the outer one
+            return
+        self._batch = []
+        self._batch_sent = []
+        try:
+            yield self
+            self._flush_batch()
+        finally:
+            sent = self._batch_sent
+            self._batch = self._batch_sent = None
+
+        errors = []
+        while True:
+            error = self._read_error()
+            if error is None:
+                break
+            errors.append(error)
+        if errors:
+            error = errors[0]
+            error.command = self._guess_failed_command(error, sent)
+            raise error
+
+    def _guess_failed_command(self, error, commands):
+        '''
+        The ESP300 doesn't say which command caused an error, but errors of
+        100 and up are specific to the axis in the hundreds digit. Return the
+        command for that axis if there is only one, or otherwise all the
+        commands.
+        '''
+        axis = str(error.code // 100)
+        if error.code >= 100:
+            candidates = [command for command in commands
+                if command.startswith(axis) and
+                    not command[len(axis):len(axis) + 1].isdigit()]
+            if len(candidates) == 1:
+                return candidates[0]
+        return ';'.join(commands)
+
+    def query_axes(self, commands='TP', axes=(1, 2, 3)):
+        '''
+        Query one or more @commands (without question mark, e.g. 'TP' or
+        ['TP', 'VA']) for all of @axes with as few compound queries as
+        possible. Returns a NumPy array of shape (len(axes),) for a single
+        command, or (len(commands), len(axes)) for a list of commands.
+            x, y, z = esp.query_axes('TP')
+        '''
+        single = isinstance(commands, basestring)
+        if single:
+            commands = [commands]
+        queries = ['{0}{1}?'.format(axis, command)
+            for command in commands for axis in axes]
+
+        self._flush_batch()
+        values = []
+        try:
+            for line in self._join_lines(queries):
+                reply = self.ask(line)
+                values.extend(float(value) for value in reply.split(','))
+        except pyvisa.visa_exceptions.VisaIOError as e:
+            self._check_error()
+            raise e
+        except ValueError:
+            self._check_error()
+            raise ESP300Error(0, 0, 'Garbled reply to compound query')
+        if len(values) != len(queries):
+            self._check_error()
+            raise ESP300Error(0, 0, 'Expected {0} values, got {1}'.format(
+                len(queries), len(values)))
+
+        values = N.array(values).reshape(len(commands), len(axes))
+        return values[0] if single else values
+
+    def read_positions(self, axes=(1, 2, 3)):
+        '''Actual positions of @axes as a NumPy array, in one query.'''
+        return self.query_axes('TP', axes)
 
     def move_relative(self, distance, axis=1):
         '''PR command - move relative'''
-        _command(self, 'PR', axis, distance)
-        self._check_error()
+        self._send(_command('PR', axis, distance))
+
+    def move_absolute(self, position, axis=1):
+        '''PA command - move absolute'''
+        self._send(_command('PA', axis, position))
 
     def poll_motion_done(self, axis=1):
         '''MD (motion done status) command in a loop'''
-        while self.ask('{0}MD?'.format(axis)) == '0':
-            pass
+        self.wait_motion_done(axis, use_srq=False)
+
+    def motion_done(self, axes=(1,)):
+        '''
+        MD (motion done status) command for all of @axes in one query.
+        Returns a list of booleans.
+        '''
+        self._flush_batch()
+        reply = self.ask(';'.join('{0}MD?'.format(axis) for axis in axes))
+        return [value.strip() != '0' for value in reply.split(',')]
+
+    def wait_motion_done(self, axes=(1,), timeout=None, use_srq=False,
+            min_interval=0.005, max_interval=0.1):
+        '''
+        Wait until all of @axes (a list, or a single axis number) have
+        stopped, for at most @timeout seconds; raises TimeoutError if they
+        don't. If @use_srq is True, the ESP300 sends a service request when
+        the axes have stopped (WS and RQ commands), and the GPIB bus is left
+        alone until then. Otherwise, MD? is polled, starting at
+        @min_interval seconds and backing off to at most @max_interval
+        seconds, so that other instruments on the bus stay responsive.
+        '''
+        if isinstance(axes, int):
+            axes = (axes,)
+        if use_srq:
+            self._flush_batch()
+            self.write(';'.join(['{0}WS'.format(axis) for axis in axes] +
+                ['RQ']))
+            try:
+                self.wait_for_srq(timeout)
+            except pyvisa.visa_exceptions.VisaIOError:
+                self._check_error()
+                raise TimeoutError('Axes {0} did not stop within {1} s'.format(
+                    ', '.join(str(axis) for axis in axes), timeout))
+        else:
+            deadline = None if timeout is None else time.time() + timeout
+            interval = min_interval
+            while not all(self.motion_done(axes)):
+                if deadline is not None and time.time() + interval > deadline:
+                    self._check_error()
+                    raise TimeoutError('Axes {0} did not stop within '
+                        '{1} s'.format(', '.join(str(axis) for axis in axes),
+                        timeout))
+                time.sleep(interval)
+                interval = min(2 * interval, max_interval)
         self._check_error()
 
     def sync(self, wait_time=0.0, stamp=0, axis=1):
@@ -104,9 +320,114 @@ class ESP300(visa.GpibInstrument, object):
         @wait_time milliseconds, then sends a service request with the
         lowest five bytes equal to @stamp. Note that this does not pause
         program execution. Use wait_for_srq() to sync with this signal
-        and pyvisa.vpp43.read_stb(Instrument.vi) to check the stamp.'''
-        _command(self, 'WS', axis, wait_time)
-        self.write('RQ{0}'.format(stamp))
+        and pyvisa.vpp43.read_stb(Instrument.vi) to check the stamp, or
+        wait_for_stamp() to do both.'''
+        command = self._sync_command(wait_time, stamp, axis)
+        if self._batch is not None:
+            self._batch.append(command)
+        else:
+            self.write(command)
+
+    def _sync_command(self, wait_time, stamp, axis):
+        return '{0};RQ{1}'.format(_command('WS', axis, wait_time), stamp)
+
+    def wait_for_stamp(self, timeout=25):
+        '''
+        Wait for a service request from sync() for at most @timeout seconds,
+        and return its stamp. Raises TimeoutError if none arrives.
+        '''
+        try:
+            self.wait_for_srq(timeout)
+        except pyvisa.visa_exceptions.VisaIOError:
+            self._check_error()
+            raise TimeoutError('No service request within {0} s'.format(
+                timeout))
+        return vpp43.read_stb(self.vi) & 0x1F
+
+    def upload_trajectory(self, positions, dwell_times, axes=(1, 2, 3),
+            program=1, settle_time=0.0):
+        '''
+        Compile a point-by-point trajectory into onboard program number
+        @program (1-100) and store it in the ESP300, replacing any program
+        with that number. @positions is a sequence of position tuples, one
+        coordinate per axis in @axes. At each point, the program waits until
+        the axes have stopped plus @settle_time milliseconds, sends a service
+        request with the point index (modulo 32) as stamp, and then waits the
+        point's dwell time in milliseconds. @dwell_times can also be a single
+        number for all points. Start the program with run_program().
+        '''
+        positions = N.atleast_2d(N.asarray(positions, dtype=float))
+        if positions.shape[1] != len(axes):
+            raise ValueError('Need one coordinate for each of axes {0}'.format(
+                axes))
+        dwell_times = N.asarray(dwell_times, dtype=float)
+        if dwell_times.ndim == 0:
+            dwell_times = N.repeat(dwell_times, len(positions))
+
+        commands = []
+        for i, (point, dwell_time) in enumerate(zip(positions, dwell_times)):
+            commands.extend(_command('PA', axis, coordinate)
+                for axis, coordinate in zip(axes, point))
+            commands.extend('{0}WS'.format(axis) for axis in axes[:-1])
+            commands.append(self._sync_command(settle_time, i % 32, axes[-1]))
+            if dwell_time > 0:
+                commands.append('WT{0}'.format(float(dwell_time)))
+
+        self._flush_batch()
+        self.write('{0}XX'.format(program))
+        self._read_error()  # deleting a nonexistent program is not an error
+        self.write('{0}EP'.format(program))
+        for line in self._join_lines(commands):
+            self.write(line)
+        self.write('QP')
+        self._check_error()
+
+    def run_program(self, program=1):
+        '''EX command - execute a stored program'''
+        self._send('{0}EX'.format(program))
+
+    def run_trajectory(self, n_points, acquire, program=1, timeout=25):
+        '''
+        Start a program stored with upload_trajectory() and call @acquire
+        with the point index whenever the stages have arrived at a point,
+        during the dwell time. Returns the list of @acquire's return values.
+        Raises TimeoutError if no point is reached within @timeout seconds,
+        and ESP300Error if a point was missed, which means that @acquire
+        takes longer than the dwell time.
+        '''
+        self.run_program(program)
+        results = []
+        for i in range(n_points):
+            stamp = self.wait_for_stamp(timeout)
+            if stamp != i % 32:
+                raise ESP300Error(0, 0, 'Missed trajectory point {0}; the '
+                    'dwell time is too short'.format(i))
+            results.append(acquire(i))
+        return results
+
+
+class ESP300Axis(object):
+    """
+    One axis of an ESP300, with a blocking move_absolute() as used by Scan.
+    The axes of one ESP300 can be moved from different threads; their
+    commands and queries take turns on the GPIB bus.
+    """
+
+    def __init__(self, instrument, axis):
+        self.instrument = instrument
+        self.axis = axis
+
+    @property
+    def position(self):
+        return self.instrument.position[self.axis]
+
+    def move_absolute(self, position, timeout=None):
+        '''
+        Move to @position and wait until the axis has stopped, for at most
+        @timeout seconds.
+        '''
+        self.instrument.move_absolute(position, self.axis)
+        self.instrument.wait_motion_done(self.axis, timeout)
 
 if __name__ == '__main__':
     esp = ESP300(2)
@@ -115,3 +436,4 @@ if __name__ == '__main__':
     esp.position[1] = 90.0
     esp.sync()
     esp.wait_for_srq()
+
@@ -1,9 +1,10 @@
 from .ocean_optics import (OceanOpticsError, OO_ERROR_SYNC,
-    OO_ERROR_MODEL_NOT_FOUND)
+    OO_ERROR_MODEL_NOT_FOUND, initialize)
 from .spectrometers import (autodetect_spectrometer, USB2000, ADC1000, HR2000,
     HR4000, HR2000Plus, QE65000, USB2000Plus, USB4000, NIRQuest512, NIRQuest256,
     MayaPro, Maya, Torus)
 __all__ = ['OceanOpticsError', 'OO_ERROR_SYNC', 'OO_ERROR_MODEL_NOT_FOUND',
+    'initialize',
     'autodetect_spectrometer', 'USB2000', 'ADC1000', 'HR2000', 'HR4000',
     'HR2000Plus', 'QE65000', 'USB2000Plus', 'USB4000', 'NIRQuest512',
     'NIRQuest256', 'MayaPro', 'Maya', 'Torus']
@@ -1,4 +1,3 @@
-import visa
 from pyvisa import vpp43
 from pyvisa.vpp43_constants import _to_int
 from pyvisa.vpp43_attributes import attributes as _attributes
@@ -15,14 +14,6 @@ class OceanOpticsError(Exception):
 # OceanOptics extended error code?
 OO_ERROR_SYNC            = _to_int(0xBFFC0801L)
 OO_ERROR_MODEL_NOT_FOUND = _to_int(0xBFFC0803L)
-_completion_and_error_messages.update({
-    OO_ERROR_SYNC: ("OO_ERROR_SYNC",
-        "Instrument not synchronized properly. Power cycle the instrument."),
-    OO_ERROR_MODEL_NOT_FOUND: ("OO_ERROR_MODEL_NOT_FOUND",
-        "Instrument Model not found. This may mean that you selected the wrong "
-        "instrument or your instrument did not respond.  You may also be using "
-        "a model that is not officially supported by this driver.")
-})
 
 # NI USB-RAW extended attributes
 
@@ -48,18 +39,44 @@ VI_USB_END_NONE           = 0
 VI_USB_END_SHORT          = 4
 VI_USB_END_SHORT_OR_COUNT = 5
 
-_attributes[VI_ATTR_USB_BULK_OUT_PIPE]   = vpp43_types.ViInt16
-_attributes[VI_ATTR_USB_BULK_IN_PIPE]    = vpp43_types.ViInt16
-_attributes[VI_ATTR_USB_INTR_IN_PIPE]    = vpp43_types.ViInt16
-_attributes[VI_ATTR_USB_CLASS]           = vpp43_types.ViInt16
-_attributes[VI_ATTR_USB_SUBCLASS]        = vpp43_types.ViInt16
-_attributes[VI_ATTR_USB_ALT_SETTING]     = vpp43_types.ViInt16
-_attributes[VI_ATTR_USB_END_IN]          = vpp43_types.ViUInt16
-_attributes[VI_ATTR_USB_NUM_INTFCS]      = vpp43_types.ViInt16
-_attributes[VI_ATTR_USB_NUM_PIPES]       = vpp43_types.ViInt16
-_attributes[VI_ATTR_USB_BULK_OUT_STATUS] = vpp43_types.ViInt16
-_attributes[VI_ATTR_USB_BULK_IN_STATUS]  = vpp43_types.ViInt16
-_attributes[VI_ATTR_USB_INTR_IN_STATUS]  = vpp43_types.ViInt16
+# Set by initialize(), so that importing this module doesn't load the VISA
+# library
+visa = None
+
+
+def initialize():
+    """
+    Load the VISA library and register the Ocean Optics error codes and the NI
+    USB-RAW attributes with pyvisa. This is done when the first spectrometer
+    is created; call it earlier to pay the cost up front.
+    """
+    global visa
+    if visa is not None:
+        return
+    import visa
+    _completion_and_error_messages.update({
+        OO_ERROR_SYNC: ("OO_ERROR_SYNC",
+            "Instrument not synchronized properly. Power cycle the "
+            "instrument."),
+        OO_ERROR_MODEL_NOT_FOUND: ("OO_ERROR_MODEL_NOT_FOUND",
+            "Instrument Model not found. This may mean that you selected the "
+            "wrong instrument or your instrument did not respond.  You may "
+            "also be using a model that is not officially supported by this "
+            "driver.")
+    })
+
+    _attributes[VI_ATTR_USB_BULK_OUT_PIPE]   = vpp43_types.ViInt16
+    _attributes[VI_ATTR_USB_BULK_IN_PIPE]    = vpp43_types.ViInt16
+    _attributes[VI_ATTR_USB_INTR_IN_PIPE]    = vpp43_types.ViInt16
+    _attributes[VI_ATTR_USB_CLASS]           = vpp43_types.ViInt16
+    _attributes[VI_ATTR_USB_SUBCLASS]        = vpp43_types.ViInt16
+    _attributes[VI_ATTR_USB_ALT_SETTING]     = vpp43_types.ViInt16
+    _attributes[VI_ATTR_USB_END_IN]          = vpp43_types.ViUInt16
+    _attributes[VI_ATTR_USB_NUM_INTFCS]      = vpp43_types.ViInt16
+    _attributes[VI_ATTR_USB_NUM_PIPES]       = vpp43_types.ViInt16
+    _attributes[VI_ATTR_USB_BULK_OUT_STATUS] = vpp43_types.ViInt16
+    _attributes[VI_ATTR_USB_BULK_IN_STATUS]  = vpp43_types.ViInt16
+    _attributes[VI_ATTR_USB_INTR_IN_STATUS]  = vpp43_types.ViInt16
 
 
 class OceanOptics(object):
@@ -68,6 +85,7 @@ class OceanOptics(object):
         """
         @timeout in milliseconds
         """
+        initialize()
         self._resource_name = resource_name
         self._timeout = timeout
 
@@ -1,6 +1,6 @@
+from . import ocean_optics
 from .ocean_optics import (OceanOptics2k, OceanOptics4k, OceanOpticsNIRQuest,
     OceanOpticsMaya, OO_ERROR_MODEL_NOT_FOUND)
-import visa
 from pyvisa import vpp43
 import struct
 
@@ -10,6 +10,8 @@ def autodetect_spectrometer(resource_name, *args, **kwargs):
     Factory method which creates an appropriate instrument object, depending
     on the model code that the unit identifies itself with.
     """
+    ocean_optics.initialize()
+    visa = ocean_optics.visa
     vi = vpp43.open(visa.resource_manager.session, resource_name)
     model_code = vpp43.get_attribute(vi, vpp43.VI_ATTR_MODEL_CODE)
     vpp43.close(vi)
@@ -0,0 +1,182 @@
+import time
+import numpy as N
+
+from .futures import run_in_thread, wait_all
+
+__all__ = ['Detector', 'Scan']
+
+_PHASES = ('move', 'settle', 'acquire', 'read')
+
+
+class Detector(object):
+    """
+    A detector that takes one measurement at every point of a Scan.
+    @acquire is called while the stages are standing still at the point. If
+    @read is given, it is called afterwards to fetch the data, while the
+    stages already move to the next point; otherwise @acquire must return the
+    data. The data can be a number or a NumPy array of the same shape at
+    every point.
+    """
+
+    def __init__(self, name, acquire, read=None):
+        self.name = name
+        self.acquire = acquire
+        self.read = read
+
+    @classmethod
+    def from_camera(cls, name, camera):
+        '''Detector that captures a frame from a Camera.'''
+        def acquire():
+            camera.query_frame()
+            return camera.frame
+        return cls(name, acquire)
+
+    @classmethod
+    def from_spectrometer(cls, name, spectrometer):
+        '''Detector that reads a spectrum from an Ocean Optics spectrometer.'''
+        return cls(name, spectrometer.read_spectrum)
+
+
+def _snake_order(shape):
+    '''
+    All index tuples of an array of @shape, in an order where the fastest
+    axis reverses direction on every line, so that the stages never fly back.
+    '''
+    if len(shape) == 1:
+        return [(i,) for i in range(shape[0])]
+    inner = _snake_order(shape[1:])
+    order = []
+    for i in range(shape[0]):
+        line = inner if i % 2 == 0 else inner[::-1]
+        order.extend((i,) + index for index in line)
+    return order
+
+
+def _start_move(stage, position):
+    '''
+    Start moving @stage to @position and return a Future. Stages with a
+    move_absolute_async() method, such as APTAxis, move in the background by
+    themselves; blocking move_absolute() methods and plain callables are run
+    in a background thread.
+    '''
+    if hasattr(stage, 'move_absolute_async'):
+        return stage.move_absolute_async(position)
+    if hasattr(stage, 'move_absolute'):
+        return run_in_thread(stage.move_absolute, position)
+    return run_in_thread(stage, position)
+
+
+class Scan(object):
+    """
+    Moves one or more stages through a list of positions and takes a
+    measurement with every detector at each position. The move to the next
+    position starts as soon as the detectors have acquired, so that reading
+    out the data overlaps with the move. Results are stored in preallocated
+    arrays, and the time spent in each phase is recorded.
+
+    Stages can be APTAxis or ESP300Axis objects or anything else with a
+    move_absolute() method, or functions that take a position and return when
+    the stage has arrived there. Stages that share an instrument must be safe
+    to move from several threads at once, as the ESP300Axis objects are.
+    """
+
+    def __init__(self, stages, positions, detectors, settle_time=0.0):
+        """
+        @stages: list of stages, one for each coordinate
+        @positions: sequence of position tuples, one coordinate per stage
+        @detectors: list of Detectors
+        @settle_time: time in seconds to wait after each move
+        """
+        self.stages = list(stages)
+        self.detectors = list(detectors)
+        self.settle_time = settle_time
+        positions = [tuple(position) for position in positions]
+        self._shape = (len(positions),)
+        self._points = [((i,), position)
+            for i, position in enumerate(positions)]
+        self.results = None
+        self.timing = None
+
+    @classmethod
+    def grid(cls, stages, axes, detectors, snake=True, settle_time=0.0):
+        """
+        Scan over the grid spanned by @axes, a list of 1-D sequences of
+        positions, one for each stage; the last stage moves fastest. The
+        results have the shape of the grid, followed by the shape of the
+        detector data. If @snake is True, the fast axes reverse direction on
+        every line to shorten the travel.
+        """
+        axes = [N.asarray(axis) for axis in axes]
+        shape = tuple(len(axis) for axis in axes)
+        if snake:
+            order = _snake_order(shape)
+        else:
+            order = list(N.ndindex(*shape))
+        scan = cls(stages, [], detectors, settle_time)
+        scan._shape = shape
+        scan._points = [(index,
+            tuple(axis[i] for axis, i in zip(axes, index)))
+            for index in order]
+        return scan
+
+    @property
+    def shape(self):
+        '''Shape of the scan, without the shape of the detector data.'''
+        return self._shape
+
+    def _start_moves(self, position, current):
+        '''Start the moves of the stages whose coordinate changes.'''
+        futures = []
+        for k, (stage, coordinate) in enumerate(zip(self.stages, position)):
+            if current[k] != coordinate:
+                futures.append(_start_move(stage, coordinate))
+                current[k] = coordinate
+        return futures
+
+    def _store(self, name, index, data):
+        data = N.asarray(data)
+        result = self.results.get(name)
+        if result is None:
+            result = N.empty(self._shape + data.shape, dtype=data.dtype)
+            self.results[name] = result
+        result[index] = data
+
+    def run(self):
+        """
+        Run the scan. Returns a dictionary of result arrays, indexed by
+        detector name. Afterwards, the timing attribute holds the total time
+        in seconds spent waiting for moves ('move'), settling ('settle'),
+        acquiring ('acquire') and reading out and storing data ('read').
+        """
+        self.results = {}
+        self.timing = dict.fromkeys(_PHASES, 0.0)
+        if not self._points:
+            return self.results
+
+        current = [None] * len(self.stages)
+        moves = self._start_moves(self._points[0][1], current)
+        for i, (index, position) in enumerate(self._points):
+            start = time.time()
+            wait_all(moves)
+            after_move = time.time()
+            if self.settle_time:
+                time.sleep(self.settle_time)
+            after_settle = time.time()
+            acquired = [(detector, detector.acquire())
+                for detector in self.detectors]
+            after_acquire = time.time()
+
+            # Read out while moving on to the next point
+            if i + 1 < len(self._points):
+                moves = self._start_moves(self._points[i + 1][1], current)
+            for detector, data in acquired:
+                if detector.read is not None:
+                    data = detector.read()
+                self._store(detector.name, index, data)
+            end = time.time()
+
+            self.timing['move'] += after_move - start
+            self.timing['settle'] += after_settle - after_move
+            self.timing['acquire'] += after_acquire - after_settle
+            self.timing['read'] += end - after_acquire
+        return self.results
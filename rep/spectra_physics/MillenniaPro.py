@@ -1,22 +1,162 @@
+import time
+import threading
 import visa
+import pyvisa.visa_exceptions
+
+from ..futures import TimeoutError
+
+
+class LaserState(object):
+    """
+    Snapshot of the laser's health, as last polled by the MillenniaPro's
+    monitor thread. Values are None until they have been read.
+    """
+
+    def __init__(self, warmup_percentage=None, power=None, status=None,
+            timestamp=None, error=None):
+        self.warmup_percentage = warmup_percentage
+        self.power = power  # W
+        self.status = status  # status byte
+        self.timestamp = timestamp  # time.time() of the last poll
+        self.error = error  # exception raised by the last poll, if any
+
+    @property
+    def ready(self):
+        return self.warmup_percentage == 100
+
+    def __repr__(self):
+        return ('LaserState(warmup_percentage={0}, power={1}, status={2}, '
+            'timestamp={3})'.format(self.warmup_percentage, self.power,
+            self.status, self.timestamp))
 
 
 class MillenniaPro(visa.SerialInstrument, object):
     """Millennia Pro Laser"""
     def __init__(self, com_port=1, *args, **kwargs):
+        self._io_lock = threading.RLock()
+        self._identity = None
+        self._state = LaserState()
+        self._state_changed = threading.Condition()
+        self._monitor_thread = None
+        self._monitor_stop = threading.Event()
+        self._monitor_lock = threading.Lock()  # starting and stopping
         visa.SerialInstrument.__init__(self,
             'COM{}'.format(com_port),
             term_chars=visa.LF)
 
+    # The monitor thread and the caller share the serial port
+    def ask(self, message):
+        with self._io_lock:
+            return visa.SerialInstrument.ask(self, message)
+
+    @property
+    def id_string(self):
+        """Reply to *idn?, read once per session"""
+        if self._identity is None:
+            self._identity = self.ask('*idn?')
+        return self._identity
+
     @property
     def model(self):
-        _, model_name, _, _ = self.ask('*idn?').split(',')
+        _, model_name, _, _ = self.id_string.split(',')
         return model_name
 
+    @property
+    def serial_number(self):
+        return self.id_string.split(',')[2]
+
     @property
     def warmup_percentage(self):
         return int(self.ask('?warmup%')[:-1])  # strip trailing % character
 
+    @property
+    def power(self):
+        """Output power in W"""
+        return float(self.ask('?P').rstrip('W'))
+
+    @property
+    def status(self):
+        """Status byte"""
+        return int(self.ask('?STB'))
+
+    @property
+    def state(self):
+        """LaserState from the monitor's last poll; never waits for the
+        laser"""
+        return self._state
+
+    @property
+    def monitoring(self):
+        return self._monitor_thread is not None
+
+    def poll(self):
+        """Read warmup, power and status into a new LaserState."""
+        try:
+            state = LaserState(self.warmup_percentage, self.power,
+                self.status, time.time())
+        except (pyvisa.visa_exceptions.VisaIOError, ValueError) as e:
+            state = LaserState(self._state.warmup_percentage,
+                self._state.power, self._state.status, time.time(), e)
+        with self._state_changed:
+            self._state = state
+            self._state_changed.notify_all()
+        return state
+
+    def start_monitor(self, interval=2.0):
+        """
+        Poll the laser's health every @interval seconds in a background
+        thread. The result is available as the state property.
+        """
+        with self._monitor_lock:
+            if self.monitoring:
+                return
+            self._monitor_stop.clear()
+            self._monitor_thread = threading.Thread(
+                target=self._monitor_loop, args=(interval,))
+            self._monitor_thread.daemon = True
+            self._monitor_thread.start()
+
+    def stop_monitor(self):
+        with self._monitor_lock:
+            if self._monitor_thread is None:
+                return
+            self._monitor_stop.set()
+            self._monitor_thread.join()
+            self._monitor_thread = None
+
+    def _monitor_loop(self, interval):
+        while not self._monitor_stop.is_set():
+            self.poll()
+            self._monitor_stop.wait(interval)
+
+    def wait_until_ready(self, timeout=None):
+        """
+        Wait until the laser is warmed up, for at most @timeout seconds;
+        raises TimeoutError if it isn't. Starts the monitor if it isn't
+        running already; any number of threads can wait at the same time.
+        """
+        self.start_monitor()
+        deadline = None if timeout is None else time.time() + timeout
+        with self._state_changed:
+            while not self._state.ready:
+                if deadline is None:
+                    self._state_changed.wait(1.0)
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError('Laser not warmed up within {} s '
+                        '({}%)'.format(timeout,
+                        self._state.warmup_percentage))
+                self._state_changed.wait(remaining)
+        return self._state
+
+    # Context manager that stops the monitor
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop_monitor()
+
 if __name__ == '__main__':
     laser = MillenniaPro()
     print laser.model
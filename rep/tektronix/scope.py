@@ -1,16 +1,122 @@
+import time
+import calendar
 import numpy as N
 import visa
 
+from ..futures import TimeoutError
+from .waveforms import WaveformSet
+
 # Original code kindly contributed by Filip Dominec <dominecf@fzu.cz>
 # See http://www.fzu.cz/~dominecf/python/FDLabInstruments.py
 
 
+def _parse_block(raw):
+    '''
+    Find the data in an IEEE 488.2 definite length block, '#' followed by
+    the number of length digits, the length in bytes, and the data. Returns
+    the offset and length of the data within @raw.
+    '''
+    start = raw.find('#')
+    if start == -1 or start + 2 > len(raw):
+        raise ValueError('No binary block in reply')
+    n_digits = int(raw[start + 1])
+    if n_digits == 0:
+        raise ValueError('Indefinite length blocks are not supported')
+    offset = start + 2 + n_digits
+    length = int(raw[start + 2:offset])
+    if offset + length > len(raw):
+        raise ValueError('Binary block is truncated: expected {0} bytes, got '
+            '{1}'.format(length, len(raw) - offset))
+    return offset, length
+
+
+class WaveformPreamble(object):
+    """
+    The scaling of a channel's waveform data, from the WFMPre? query. Data
+    points are converted to volts as (point - y_offset) * y_multiplier +
+    y_zero; point i is at time x_zero + (i - pt_offset) * x_increment.
+    """
+
+    # Short and long forms of the preamble fields that are used, and
+    # attribute names. Keys must match exactly: DPO/MSO scopes also reply
+    # with e.g. PT_ORDER (short form PT_OR), which is not PT_OFF
+    _FIELDS = {
+        'NR_P': ('n_points', int),
+        'NR_PT': ('n_points', int),
+        'PT_O': ('pt_offset', int),
+        'PT_OF': ('pt_offset', int),
+        'PT_OFF': ('pt_offset', int),
+        'XIN': ('x_increment', float),
+        'XINCR': ('x_increment', float),
+        'XZE': ('x_zero', float),
+        'XZERO': ('x_zero', float),
+        'YMU': ('y_multiplier', float),
+        'YMULT': ('y_multiplier', float),
+        'YOF': ('y_offset', float),
+        'YOFF': ('y_offset', float),
+        'YZE': ('y_zero', float),
+        'YZERO': ('y_zero', float),
+    }
+
+    def __init__(self, reply):
+        """
+        @reply: reply to WFMPre? with headers switched on, e.g.
+        ':WFMPRE:BYT_NR 2;BIT_NR 16;...;YZERO 0.0E+0'
+        """
+        for field in reply.strip().split(';'):
+            if ' ' not in field:
+                continue
+            key, value = field.split(' ', 1)
+            key = key.rsplit(':', 1)[-1].upper()
+            if key in self._FIELDS:
+                name, convert = self._FIELDS[key]
+                setattr(self, name, convert(float(value)))
+        missing = sorted(set(name for name, _ in self._FIELDS.values()
+            if not hasattr(self, name)))
+        if missing:
+            raise ValueError('Preamble is missing ' + ', '.join(missing))
+
+    def scale(self, data):
+        '''Convert raw data points to volts.'''
+        return (data - self.y_offset) * self.y_multiplier + self.y_zero
+
+    def scale_float32(self, data, out=None):
+        '''
+        Convert raw data points to volts as a float32 array, or into @out,
+        scaling in place to avoid temporary arrays.
+        '''
+        if out is None:
+            volts = data.astype(N.float32)
+        else:
+            volts = out
+            volts[...] = data
+        volts -= self.y_offset
+        volts *= self.y_multiplier
+        volts += self.y_zero
+        return volts
+
+
+def _parse_timestamp(timestamp):
+    '''
+    Convert a FastFrame time stamp, such as "02 Jan 2012 15:02:23.123456789012",
+    to seconds since the epoch, taking the scope's clock to be UTC.
+    '''
+    timestamp = timestamp.strip().strip('"')
+    whole, fraction = timestamp.split('.')
+    seconds = calendar.timegm(time.strptime(whole, '%d %b %Y %H:%M:%S'))
+    return seconds + float('0.' + fraction)
+
+
 class Oscilloscope(object, visa.GpibInstrument):
     """A Tektronix digital sampling oscilloscope."""
 
     def __init__(self, *args, **kwargs):
         visa.GpibInstrument.__init__(self, *args, **kwargs)
         # Tektronix scope identifies as USB0::0x699::0x0401::C021641... etc.
+        self._record_length = None  # cached, None if unknown
+        # Number of data points read in one CURV? query; long records are
+        # transferred in chunks of this size to keep memory use bounded
+        self.points_per_transfer = 1000000
 
     # Dummy context manager
     def __enter__(self):
@@ -27,50 +133,220 @@ class Oscilloscope(object, visa.GpibInstrument):
     def event_status_register(self):
         return self.ask('*ESR?')
 
-    def _get_waveform_from_channel(self, channel):
-        # The channel must be selected first, TODO
-        self.write(':DATA:SOU CH{};'.format(channel))
+    @property
+    def record_length(self):
+        """Number of points in a record: 1000, 10000, ... up to the maximum
+        of the scope"""
+        if self._record_length is None:
+            self._record_length = int(float(self.ask(':HOR:RECORDL?')))
+        return self._record_length
+
+    @record_length.setter
+    def record_length(self, value):
+        self.write(':HOR:RECORDL {:d}'.format(value))
+        self._record_length = None
+
+    def _select_source(self, source):
+        # Signed 16-bit big-endian data points, the whole record
+        self.write(':DATA:SOU {};:DATA:ENC RIB;WID 2;START 1;STOP {};'.format(
+            source, self.record_length))
+
+    def _get_preamble(self):
+        '''
+        Waveform preamble of the selected source, fetched in one query. It is
+        read again for every record, because the scaling can also be changed
+        on the front panel.
+        '''
+        reply = self.ask(':HEAD ON;:VERB OFF;:WFMP?;:HEAD OFF')
+        return WaveformPreamble(reply)
+
+    def _read_curve(self):
+        '''
+        Read the data points of the selected channel as a binary block. The
+        returned array is big-endian and shares memory with the reply.
+        '''
+        self.write(':CURV?')
+        raw = self.read_raw()
+        offset, length = _parse_block(raw)
+        return N.frombuffer(raw, N.dtype('>i2'), length // 2, offset)
+
+    def read_raw_waveform(self, channel, out=None):
+        '''
+        Read the record of @channel as 16-bit data points, in chunks of
+        points_per_transfer points, into @out or a newly allocated int16
+        array. Returns the array and the channel's WaveformPreamble, which
+        converts it to volts.
+        '''
+        return self._read_record('CH{}'.format(channel), out)
 
-        # Get info about the waveform settings
-        self.write(':DAT:WID 2;')
-        y_multiplier = float(self.ask(':WFMP:YMU?'))
-        y_offset = float(self.ask(':WFMP:YOF?'))
-        y_zero = float(self.ask(':WFMP:YZE?'))
+    def _read_record(self, source, out=None):
+        n_points = self.record_length
+        if out is None:
+            out = N.empty(n_points, N.int16)
+        elif out.shape != (n_points,):
+            raise ValueError('Output array must have shape ({},)'.format(
+                n_points))
+        self._select_source(source)
+        preamble = self._get_preamble()
 
-        # Retrieve waveform for selected channel as a long string with number of
-        # samples prepended
-        raw_wform = self.ask(':CURV?')
-        data_points_num_digits = int(raw_wform[1])
+        if n_points <= self.points_per_transfer:
+            out[:] = self._read_curve()
+            return out, preamble
+        for start in range(0, n_points, self.points_per_transfer):
+            stop = min(start + self.points_per_transfer, n_points)
+            self.write(':DATA:START {};STOP {};'.format(start + 1, stop))
+            chunk = self._read_curve()
+            if len(chunk) != stop - start:
+                raise ValueError('Expected {} data points, got {}'.format(
+                    stop - start, len(chunk)))
+            out[start:stop] = chunk
+        return out, preamble
 
-        # Convert bytes to waveform
-        wform = N.fromstring(raw_wform[(data_points_num_digits + 2):],
-            N.dtype('>i2'))
-        return (wform - y_offset) * y_multiplier - y_zero
+    def read_waveform(self, channel):
+        '''
+        Read the record of @channel and convert it to volts, as a float32
+        array.
+        '''
+        raw, preamble = self.read_raw_waveform(channel)
+        return preamble.scale_float32(raw)
 
-    def get_waveforms(self, channels):
+    def read_waveform_set(self, channels, record_length=None):
         """
-        Retrieves the waveforms from the given channels as a numpy.ndarray.
-        Returns an array of ndarrays, of length len(channels) + 1, with the
-        timebase as the last element.
+        Acquire once and retrieve the waveforms from the given channels as a
+        WaveformSet, with the data stacked in one (channels, samples) float32
+        array.
         @channels: array of integers (e.g. [1, 2])
+        @record_length: if given, set the record length first
         """
-
-        # Configure scope record length (100kS and more causes lags)
-        self.write(':HOR:RECORDL 10000')  # record length: (1k 10k ... 10M)
+        if record_length is not None and record_length != self.record_length:
+            self.record_length = record_length
 
         self.write(':ACQ:STATE ON;')
         self.write(':ACQ:STATE OFF;')
 
-        x_increment = float(self.ask(':WFMP:XIN?'))
-
-        wforms = [self._get_waveform_from_channel(channel)
-            for channel in channels]
+        data = N.empty((len(channels), self.record_length), N.float32)
+        raw = N.empty(self.record_length, N.int16)
+        for wform, channel in zip(data, channels):
+            raw, preamble = self.read_raw_waveform(channel, raw)
+            preamble.scale_float32(raw, wform)
 
         self.write(':ACQ:STATE ON;')
+        return WaveformSet(data, preamble.x_increment, preamble.x_zero,
+            preamble.pt_offset, channels)
+
+    def get_waveforms(self, channels, record_length=None):
+        """
+        Retrieves the waveforms from the given channels as a numpy.ndarray.
+        Returns an array of ndarrays, of length len(channels) + 1, with the
+        timebase as the last element. See read_waveform_set() for a more
+        compact alternative.
+        @channels: array of integers (e.g. [1, 2])
+        @record_length: if given, set the record length first
+        """
+        waveforms = self.read_waveform_set(channels, record_length)
+        wforms = list(waveforms.data)
 
-        # Generate linear timebase (matching the last wform)
-        npoints = len(wforms[-1])
-        timebase = N.linspace(0, x_increment * (npoints - 1), num=npoints)
+        # Generate linear timebase
+        timebase = N.arange(waveforms.n_samples) * waveforms.x_increment
         wforms.append(timebase)
 
         return wforms
+
+    def _wait_acquisition(self, timeout=None, min_interval=0.001,
+            max_interval=0.05):
+        '''
+        Wait until a single sequence acquisition has stopped, polling with
+        backoff, for at most @timeout seconds.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        interval = min_interval
+        while int(self.ask(':ACQ:STATE?')) != 0:
+            if deadline is not None and time.time() + interval > deadline:
+                raise TimeoutError('Acquisition did not finish within '
+                    '{} s'.format(timeout))
+            time.sleep(interval)
+            interval = min(2 * interval, max_interval)
+
+    def _read_frames(self, source, n_frames):
+        '''
+        Read @n_frames FastFrame frames of @source into a (frames, points)
+        int16 array, several frames per transfer as far as
+        points_per_transfer allows.
+        '''
+        n_points = self.record_length
+        out = N.empty((n_frames, n_points), N.int16)
+        self._select_source(source)
+        preamble = self._get_preamble()
+        frames_per_transfer = max(1, self.points_per_transfer // n_points)
+        for start in range(0, n_frames, frames_per_transfer):
+            stop = min(start + frames_per_transfer, n_frames)
+            self.write(':DATA:FRAMESTART {};FRAMESTOP {};'.format(start + 1,
+                stop))
+            chunk = self._read_curve()
+            if len(chunk) != (stop - start) * n_points:
+                raise ValueError('Expected {} data points, got {}'.format(
+                    (stop - start) * n_points, len(chunk)))
+            out[start:stop] = chunk.reshape(stop - start, n_points)
+        return out, preamble
+
+    def acquire_segments(self, channels, n_segments=1, n_acquisitions=None,
+            timeout=None):
+        """
+        Acquire continuously in single sequence mode and yield one
+        acquisition after the other, until @n_acquisitions (default:
+        forever). If @n_segments is more than 1, each acquisition is a
+        FastFrame acquisition of that many triggers. Every acquisition is
+        copied into the reference memories and the next one is armed before
+        the data are transferred, so the scope keeps acquiring during the
+        transfer.
+
+        Yields a WaveformSet of shape (segments, channels, samples) in volts,
+        whose timestamps are the trigger time of each segment, in seconds
+        since the epoch. Without FastFrame, the time is the host's time when
+        the acquisition was found to be finished.
+        @channels: array of integers (e.g. [1, 2]), at most 4 channels
+        @timeout: raise TimeoutError if an acquisition takes longer than this
+        many seconds
+        """
+        if len(channels) > 4:
+            raise ValueError('Only 4 reference memories available')
+        fast_frame = n_segments > 1
+        refs = ['REF{}'.format(i + 1) for i in range(len(channels))]
+        if fast_frame:
+            self.write(':HOR:FAST:STATE ON;COUN {:d};'.format(n_segments))
+        else:
+            self.write(':HOR:FAST:STATE OFF;')
+        self.write(':ACQ:STOPA SEQ;:ACQ:STATE ON;')
+
+        count = 0
+        try:
+            while n_acquisitions is None or count < n_acquisitions:
+                self._wait_acquisition(timeout)
+                finished = time.time()
+                self.write(';'.join(':SAVE:WAVE CH{},{}'.format(channel, ref)
+                    for channel, ref in zip(channels, refs)))
+                count += 1
+                if n_acquisitions is None or count < n_acquisitions:
+                    self.write(':ACQ:STATE ON;')  # Arm the next acquisition
+
+                data = N.empty((n_segments, len(channels),
+                    self.record_length), N.float32)
+                for index, ref in enumerate(refs):
+                    if fast_frame:
+                        raw, preamble = self._read_frames(ref, n_segments)
+                    else:
+                        raw, preamble = self._read_record(ref)
+                    preamble.scale_float32(raw, data[:, index])
+                if fast_frame:
+                    reply = self.ask(':HOR:FAST:TIMES:ALL:{}? 1,{:d}'.format(
+                        refs[0], n_segments))
+                    timestamps = N.array([_parse_timestamp(timestamp)
+                        for timestamp in reply.split(',')])
+                else:
+                    timestamps = N.array([finished])
+                yield WaveformSet(data, preamble.x_increment,
+                    preamble.x_zero, preamble.pt_offset, channels, timestamps)
+        finally:
+            self.write(':ACQ:STATE OFF;:ACQ:STOPA RUNST;')
+            if fast_frame:
+                self.write(':HOR:FAST:STATE OFF;')
@@ -0,0 +1,150 @@
+import numpy as N
+
+__all__ = ['WaveformSet']
+
+
+class WaveformSet(object):
+    """
+    Waveforms of several channels that share a timebase, stored as one
+    float32 array of shape (channels, samples), or (acquisitions, channels,
+    samples) for several acquisitions or FastFrame segments. The timebase is
+    only computed when it is used. The analysis methods work on all
+    waveforms at once, along the last axis.
+    """
+
+    def __init__(self, data, x_increment, x_zero=0.0, pt_offset=0,
+            channels=None, timestamps=None):
+        """
+        @data: array of shape (channels, samples) or (acquisitions, channels,
+        samples)
+        @x_increment: time between samples in seconds
+        @x_zero: time of sample number @pt_offset
+        @channels: channel numbers, default 1, 2, ...
+        @timestamps: trigger time of each acquisition, if known
+        """
+        self.data = data
+        self.x_increment = x_increment
+        self.x_zero = x_zero
+        self.pt_offset = pt_offset
+        if channels is None:
+            channels = range(1, data.shape[-2] + 1)
+        self.channels = list(channels)
+        self.timestamps = timestamps
+        self._timebase = None
+
+    @classmethod
+    def stack(cls, waveform_sets):
+        '''
+        Stack WaveformSets of the same channels and timebase into one with
+        the acquisitions along the first axis.
+        '''
+        first = waveform_sets[0]
+        data = N.concatenate([waveforms.data.reshape((-1,) +
+            waveforms.data.shape[-2:]) for waveforms in waveform_sets])
+        timestamps = None
+        if all(waveforms.timestamps is not None
+                for waveforms in waveform_sets):
+            timestamps = N.concatenate([N.atleast_1d(waveforms.timestamps)
+                for waveforms in waveform_sets])
+        return cls(data, first.x_increment, first.x_zero, first.pt_offset,
+            first.channels, timestamps)
+
+    @property
+    def n_samples(self):
+        return self.data.shape[-1]
+
+    @property
+    def timebase(self):
+        '''Time of each sample in seconds, computed once when needed.'''
+        if self._timebase is None:
+            self._timebase = self.x_zero + (N.arange(self.n_samples) -
+                self.pt_offset) * self.x_increment
+        return self._timebase
+
+    def channel(self, channel):
+        '''Waveform(s) of channel number @channel.'''
+        return self.data[..., self.channels.index(channel), :]
+
+    def average(self):
+        '''
+        Average over all acquisitions. Returns a WaveformSet of shape
+        (channels, samples).
+        '''
+        if self.data.ndim == 2:
+            return self
+        data = self.data.reshape((-1,) + self.data.shape[-2:])
+        return WaveformSet(data.mean(axis=0, dtype=N.float64).astype(
+            self.data.dtype), self.x_increment, self.x_zero, self.pt_offset,
+            self.channels)
+
+    def frequencies(self):
+        '''Frequencies in Hz of the points of fft() and psd().'''
+        return N.fft.rfftfreq(self.n_samples, self.x_increment)
+
+    def fft(self):
+        '''One-sided discrete Fourier transform of every waveform.'''
+        return N.fft.rfft(self.data, axis=-1)
+
+    def psd(self):
+        '''
+        One-sided power spectral density of every waveform, in V^2/Hz, from
+        the periodogram.
+        '''
+        spectrum = N.fft.rfft(self.data, axis=-1)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2) * (
+            self.x_increment / self.n_samples)
+        # Fold in the negative frequencies, except at DC and Nyquist
+        if self.n_samples % 2 == 0:
+            power[..., 1:-1] *= 2
+        else:
+            power[..., 1:] *= 2
+        return power
+
+    def rise_time(self, low=0.1, high=0.9):
+        '''
+        Time in seconds that each waveform takes to rise from @low to @high
+        times its amplitude above its minimum, measured between the first
+        crossings of these levels, interpolated linearly between samples.
+        NaN if a waveform doesn't cross both levels.
+        '''
+        data = self.data
+        minimum = data.min(axis=-1)[..., N.newaxis]
+        amplitude = data.max(axis=-1)[..., N.newaxis] - minimum
+        with N.errstate(invalid='ignore', divide='ignore'):
+            normalized = (data - minimum) / amplitude
+        return (self._first_crossing(normalized, high) -
+            self._first_crossing(normalized, low)) * self.x_increment
+
+    @staticmethod
+    def _first_crossing(data, level):
+        '''Fractional sample index where each waveform first reaches @level.'''
+        above = data >= level
+        index = N.argmax(above, axis=-1)
+        crossed = N.take_along_axis(above, index[..., N.newaxis],
+            axis=-1)[..., 0]
+        before = N.take_along_axis(data, N.maximum(index - 1, 0)[...,
+            N.newaxis], axis=-1)[..., 0]
+        after = N.take_along_axis(data, index[..., N.newaxis],
+            axis=-1)[..., 0]
+        with N.errstate(invalid='ignore', divide='ignore'):
+            fraction = N.where(index > 0, (level - before) / (after - before),
+                1.0)
+        return N.where(crossed, index - 1 + fraction, N.nan)
+
+    def statistics(self):
+        '''
+        Mean, standard deviation, RMS, minimum, maximum and peak-to-peak
+        value of every waveform, as a dictionary of arrays of shape
+        (channels,) or (acquisitions, channels).
+        '''
+        data = self.data
+        minimum = data.min(axis=-1)
+        maximum = data.max(axis=-1)
+        return {
+            'mean': data.mean(axis=-1, dtype=N.float64),
+            'std': data.std(axis=-1, dtype=N.float64),
+            'rms': N.sqrt(N.mean(N.square(data, dtype=N.float64), axis=-1)),
+            'min': minimum,
+            'max': maximum,
+            'peak_to_peak': maximum - minimum,
+        }
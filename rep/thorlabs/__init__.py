@@ -1,2 +1,6 @@
-from .apt_controller import APTController
-__all__ = ['APTController']
+from .apt_controller import (APTController, APTAxis, APTAxisGroup,
+    PositionHistory)
+from .simulated_apt import (SimulatedD2XX, SimulatedAPTDevice,
+    trapezoidal_move_time)
+__all__ = ['APTController', 'APTAxis', 'APTAxisGroup', 'PositionHistory',
+    'SimulatedD2XX', 'SimulatedAPTDevice', 'trapezoidal_move_time']
@@ -1,6 +1,26 @@
 import time
 import struct
-import d2xx
+import threading
+import contextlib
+import numpy as N
+
+from ..futures import Future, TimeoutError, wait_all
+from .. import trace
+
+# Imported when the first controller is opened without a driver, so that
+# importing this module is cheap and works even if d2xx isn't available
+d2xx = None
+
+
+def _load_driver():
+    global d2xx
+    if d2xx is None:
+        import d2xx
+
+
+def _message_name(packet):
+    '''Name of an APT packet for I/O tracing: its message ID in hex.'''
+    return '0x{0:04X}'.format(struct.unpack('<H', packet[:2])[0])
 
 # Position, velocity, acceleration, jerk (1 mm/s^n = X counts/s^n, n=0..3)
 # Note: not all of these are necessarily supported!
@@ -18,12 +38,124 @@ _conversion_units = {
 }
 
 
-class APTController(object):
-
-    def __init__(self, serial_number, stage):
-        self._channel_num = 1  # only support single-channel devices for now
-        self._dev = None
-        self._real_serial_number = serial_number
+class PositionHistory(object):
+    """
+    Ring buffer of timestamped stage positions, filled from the controller's
+    status update messages during a fly scan. Timestamps are the host's
+    time.time() when the message arrived.
+    """
+
+    def __init__(self, capacity=10000):
+        self._times = N.zeros(capacity)
+        self._positions = N.zeros(capacity)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, len(self._times))
+
+    def append(self, timestamp, position):
+        with self._lock:
+            index = self._count % len(self._times)
+            self._times[index] = timestamp
+            self._positions[index] = position
+            self._count += 1
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+
+    def snapshot(self):
+        '''
+        Returns copies of the stored timestamps and positions (in mm), oldest
+        first.
+        '''
+        with self._lock:
+            capacity = len(self._times)
+            if self._count <= capacity:
+                return (self._times[:self._count].copy(),
+                    self._positions[:self._count].copy())
+            start = self._count % capacity
+            return (N.roll(self._times, -start),
+                N.roll(self._positions, -start))
+
+    def interpolate(self, timestamps):
+        '''
+        Estimate the stage position at each of @timestamps by linear
+        interpolation. Timestamps outside the recorded interval give NaN.
+        '''
+        times, positions = self.snapshot()
+        return N.interp(timestamps, times, positions, left=N.nan,
+            right=N.nan)
+
+
+class _ParameterBlock(object):
+    """
+    Shadow copy of one of the controller's parameter structures, such as the
+    velocity parameters of an axis. The structure is requested from the
+    controller the first time it is needed, and written back in one SET message
+    when any of its fields change.
+    """
+
+    def __init__(self, axis, set_msgid, req_msgid, get_msgid, fmt):
+        """
+        @fmt: struct format of the message data, starting with the channel
+        """
+        self._axis = axis
+        self._set_msgid = set_msgid
+        self._req_msgid = req_msgid
+        self._get_msgid = get_msgid
+        self._fmt = fmt
+        self._values = None  # Fields after the channel, None if not cached
+        self._dirty = False
+
+    def get(self, index):
+        if self._values is None:
+            data = self._axis._request(self._req_msgid, self._get_msgid,
+                param=(self._axis._channel_num, 0))
+            self._values = list(struct.unpack(self._fmt, data)[1:])
+        return self._values[index]
+
+    def set(self, index, value):
+        self.get(index)  # make sure the other fields are known
+        self._values[index] = value
+        self._dirty = True
+        if not self._axis._batch_depth:
+            self.flush()
+
+    def flush(self):
+        if not self._dirty:
+            return
+        data = struct.pack(self._fmt, self._axis._channel_num, *self._values)
+        self._axis._send_packet(self._set_msgid, data=data)
+        self._dirty = False
+
+    def invalidate(self):
+        self._values = None
+        self._dirty = False
+
+
+class APTAxis(object):
+    """
+    One motor channel of an APT controller. Get these from
+    APTController.axis(); the APTController itself is the axis of its default
+    channel. All axes of a controller share its connection.
+    """
+
+    def __init__(self, controller, channel, stage, address=0x50):
+        """
+        @controller: APTController that owns the connection
+        @channel: channel number within the module at @address
+        @stage: stage model, see _conversion_units for supported values
+        @address: destination address of the module that drives this axis;
+        0x50 for the controller itself, or 0x21, 0x22, ... for the bays of a
+        multi-channel controller
+        """
+        self._controller = controller
+        self._channel_num = channel
+        self._address = address
+        # Replies from the generic address don't always have it as their source
+        self._reply_source = None if address == 0x50 else address
         self._stage_model = stage
 
         # Conversion units
@@ -35,23 +167,379 @@ class APTController(object):
             raise ValueError('Unknown stage model {}. '
                 'Supported values: {}'.format(stage, _conversion_units.keys()))
 
+        # Shadow copies of the controller's parameters
+        self._batch_depth = 0
+        self._velocity_params = _ParameterBlock(self, 0x0413, 0x0414, 0x0415,
+            '<HIII')
+        # MGMSG_MOT_SET/REQ/GET_VELPARAMS: channel, min velocity, acceleration,
+        # max velocity
+        self._jog_params = _ParameterBlock(self, 0x0416, 0x0417, 0x0418,
+            '<HHiiiiH')
+        # MGMSG_MOT_SET/REQ/GET_JOGPARAMS: channel, jog mode, step size,
+        # min velocity, acceleration, max velocity, stop mode
+        self._move_params = _ParameterBlock(self, 0x043A, 0x043B, 0x043C,
+            '<Hi')
+        # MGMSG_MOT_SET/REQ/GET_GENMOVEPARAMS: channel, backlash distance
+        self._parameter_blocks = (self._velocity_params, self._jog_params,
+            self._move_params)
+
+        self.position_history = None
+        self._fly_scanning = False
+        self._last_status_ack = 0.0
+
+    ### COMMUNICATIONS ###
+
+    def _send_packet(self, msgid, param=(0, 0), data=None):
+        self._controller._write_packet(msgid, param, data, dest=self._address)
+
+    def _request(self, msgid, reply_msgid, param=(0, 0), data=None):
+        """Send a request and wait for this axis's reply."""
+        return self._controller._transact(msgid, reply_msgid, param, data,
+            dest=self._address, chan=self._channel_num,
+            source=self._reply_source)
+
+    def _matches(self, source, chan):
+        return chan == self._channel_num and \
+            self._reply_source in (None, source)
+
+    ### PROPERTIES ###
+
+    @property
+    def channel(self):
+        """Channel number of this axis."""
+        return self._channel_num
+
+    @property
+    def channel_enabled(self):
+        chan, state = self._request(0x0211, 0x0212,
+            param=(self._channel_num, 0))
+        # MGMSG_MOD_REQ_CHANENABLESTATE, MGMSG_MOD_GET_CHANENABLESTATE
+        if state in (0, 1):  # apparently 0 is valid as well?!
+            return True
+        elif state == 2:
+            return False
+        else:
+            raise IOError('Device returned invalid state {}'.format(state))
+
+    @channel_enabled.setter
+    def channel_enabled(self, value):
+        state = (2, 1)[int(bool(value))]
+        self._send_packet(0x0210, param=(self._channel_num, state))
+        # MGMSG_MOD_SET_CHANENABLESTATE
+        # A spurious 0 byte is placed in the queue?? The reader thread skips it.
+
+    def _parameter_property(block_name, index, units_name, docstring):
+        def getter(self):
+            counts = getattr(self, block_name).get(index)
+            return counts / getattr(self, units_name)
+
+        def setter(self, value):
+            counts = int(value * getattr(self, units_name))
+            getattr(self, block_name).set(index, counts)
+        return property(fget=getter, fset=setter, doc=docstring)
+
+    acceleration = _parameter_property('_velocity_params', 1,
+        '_acceleration_units', """Acceleration in mm/s^2.""")
+    max_velocity = _parameter_property('_velocity_params', 2,
+        '_velocity_units', """Maximum velocity in mm/s.""")
+    jog_step_size = _parameter_property('_jog_params', 1,
+        '_position_units', """Distance of a single jog step in mm.""")
+    jog_acceleration = _parameter_property('_jog_params', 3,
+        '_acceleration_units', """Acceleration while jogging in mm/s^2.""")
+    jog_max_velocity = _parameter_property('_jog_params', 4,
+        '_velocity_units', """Maximum velocity while jogging in mm/s.""")
+    backlash_distance = _parameter_property('_move_params', 0,
+        '_position_units', """Backlash correction distance in mm.""")
+
+    @contextlib.contextmanager
+    def batch_parameters(self):
+        """
+        Context manager that collects parameter changes and sends each changed
+        parameter structure only once, at the end of the block. For example,
+        this sets acceleration and maximum velocity in one
+        MGMSG_MOT_SET_VELPARAMS message:
+            with controller.batch_parameters():
+                controller.acceleration = 10.0
+                controller.max_velocity = 2.0
+        If the block raises an exception, the changes are discarded.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        except:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                # Shadow copy no longer matches the controller
+                self.invalidate_parameters()
+            raise
+        self._batch_depth -= 1
+        if not self._batch_depth:
+            for block in self._parameter_blocks:
+                block.flush()
+
+    def invalidate_parameters(self):
+        """
+        Forget the cached parameters, so that they are requested from the
+        controller again the next time they are needed. Call this if the
+        parameters might have been changed by something else, such as the front
+        panel or another program.
+        """
+        for block in self._parameter_blocks:
+            block.invalidate()
+
+    @property
+    def position(self):
+        """
+        Position in mm. Note that assigning to this property doesn't move the
+        stage, it only resets the position counter to that value while keeping
+        the stage in the same place.
+        """
+        data = self._request(0x0411, 0x0412, param=(self._channel_num, 0))
+        # MGMSG_MOT_REQ_POSCOUNTER, MGMSG_MOT_GET_POSCOUNTER
+        chan, pos = struct.unpack('<Hi', data)
+        return pos / self._position_units
+
+    @position.setter
+    def position(self, value):
+        pos_counts = value * self._position_units
+        data = struct.pack('<Hi', self._channel_num, pos_counts)
+        self._send_packet(0x0410, data=data)  # MGMSG_MOT_SET_POSCOUNTER
+
+    ### MOVES ###
+
+    def _start_move(self, completion_msgid, *packets):
+        """
+        Send the @packets (tuples of _send_packet() arguments) that start a
+        move, and return a future that finishes when the controller reports
+        the message @completion_msgid.
+        """
+        future = Future(cancel_callback=self.stop)
+        # Register before sending, so that the completion can't be missed
+        self._controller._register_move(self, completion_msgid, future)
+        for args in packets:
+            self._send_packet(*args)
+        return future
+
+    def _wait_for_move(self, future, timeout):
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def move_relative_async(self, distance):
+        """
+        Initiate a relative move (distance given in mm) and return immediately.
+        Returns a Future whose result is the final position in mm; cancelling
+        the future stops the stage.
+        """
+        distance_counts = distance * self._position_units
+        data = struct.pack('<Hi', self._channel_num, distance_counts)
+        return self._start_move(0x0464,  # MGMSG_MOT_MOVE_COMPLETED
+            (0x0445, (0, 0), data),  # MGMSG_MOT_SET_MOVERELPARAMS
+            (0x0448, (self._channel_num, 0)))  # MGMSG_MOT_MOVE_RELATIVE
+
+    def move_relative(self, distance, timeout=None):
+        """
+        Initiate a relative move (distance given in mm) and wait for it to
+        finish. If it doesn't finish within @timeout seconds, the stage is
+        stopped and TimeoutError is raised.
+        """
+        return self._wait_for_move(self.move_relative_async(distance), timeout)
+
+    def move_absolute_async(self, position):
+        """
+        Initiate an absolute move (position given in mm) and return
+        immediately. Returns a Future whose result is the final position in mm;
+        cancelling the future stops the stage.
+        """
+        position_counts = position * self._position_units
+        data = struct.pack('<Hi', self._channel_num, position_counts)
+        return self._start_move(0x0464,  # MGMSG_MOT_MOVE_COMPLETED
+            (0x0450, (0, 0), data),  # MGMSG_MOT_SET_MOVEABSPARAMS
+            (0x0453, (self._channel_num, 0)))  # MGMSG_MOT_MOVE_ABSOLUTE
+
+    def move_absolute(self, position, timeout=None):
+        """
+        Initiate an absolute move (position given in mm) and wait for it to
+        finish. The position is relative to the current zero position, which can
+        be set by assigning to the `position` property. If the move doesn't
+        finish within @timeout seconds, the stage is stopped and TimeoutError
+        is raised.
+        """
+        return self._wait_for_move(self.move_absolute_async(position), timeout)
+
+    def move_home_async(self):
+        """
+        Initiate a homing sequence and return immediately with a Future.
+        """
+        return self._start_move(0x0444,  # MGMSG_MOT_MOVE_HOMED
+            (0x0443, (self._channel_num, 0)))  # MGMSG_MOT_MOVE_HOME
+
+    def move_home(self, timeout=None):
+        """
+        Initiate a homing sequence and wait for it to finish.
+        """
+        return self._wait_for_move(self.move_home_async(), timeout)
+
+    def stop(self, immediate=False):
+        """
+        Stop the stage, abruptly if @immediate is True or otherwise with a
+        controlled deceleration, and wait until it has stopped. A pending
+        background move is cancelled.
+        """
+        stop_mode = 0x01 if immediate else 0x02
+        move = self._controller._pending_move(self)
+        if move is None:
+            self._request(0x0465, 0x0466, param=(self._channel_num, stop_mode))
+            # MGMSG_MOT_MOVE_STOP, MGMSG_MOT_MOVE_STOPPED
+            return
+        self._send_packet(0x0465, param=(self._channel_num, stop_mode))
+        # The reader thread receives MGMSG_MOT_MOVE_STOPPED and finishes the
+        # move's future
+        move.wait(self._controller.reply_timeout)
+
+    ### FLY SCANNING ###
+
+    def _on_status_update(self, msgid, source, chan, payload):
+        if not self._matches(source, chan):
+            return
+        # Position is the second field in both kinds of status update
+        pos_counts = struct.unpack_from('<i', payload, 2)[0]
+        now = time.time()
+        self.position_history.append(now, pos_counts / self._position_units)
+        # Keep the updates coming; the controller stops sending them if they
+        # are not acknowledged about once a second
+        if now - self._last_status_ack > 0.5:
+            self._send_packet(0x0492)  # MGMSG_MOT_ACK_DCSTATUSUPDATE
+            self._last_status_ack = now
+
+    def start_fly_scan(self, capacity=10000):
+        """
+        Start recording the stage position in the background, from the
+        status update messages that the controller sends periodically, into a
+        PositionHistory of @capacity entries. Moves can be made while
+        recording, and afterwards interpolate_position() estimates where the
+        stage was at any moment.
+        """
+        self.stop_fly_scan()
+        self.position_history = PositionHistory(capacity)
+        self._fly_scanning = True
+        self._controller.subscribe(0x0481, self._on_status_update)
+        # MGMSG_MOT_GET_STATUSUPDATE
+        self._controller.subscribe(0x0491, self._on_status_update)
+        # MGMSG_MOT_GET_DCSTATUSUPDATE
+        self._send_packet(0x0011)  # MGMSG_HW_START_UPDATEMSGS
+
+    def stop_fly_scan(self):
+        """
+        Stop recording positions. The recorded positions stay available in
+        the position_history attribute until the next start_fly_scan().
+        """
+        if not self._fly_scanning:
+            return
+        self._fly_scanning = False
+        self._send_packet(0x0012)  # MGMSG_HW_STOP_UPDATEMSGS
+        self._controller.unsubscribe(0x0481, self._on_status_update)
+        self._controller.unsubscribe(0x0491, self._on_status_update)
+
+    def interpolate_position(self, timestamps):
+        """
+        Estimate the stage position in mm at each of @timestamps (values of
+        time.time()) from the positions recorded during the fly scan.
+        """
+        return self.position_history.interpolate(timestamps)
+
+
+class APTController(APTAxis):
+    """
+    Thorlabs APT motion controller, connected over USB. The controller object
+    is also the axis of the channel given to the constructor; use axis() to
+    control the other channels of a multi-channel controller. On a
+    multi-channel controller motherboard (hardware type 45) that axis is the
+    bay 0x20 + channel, which is resolved when the controller is opened.
+    """
+
+    def __init__(self, serial_number, stage, channel=1, driver=None):
+        """
+        @serial_number: serial number of the controller's USB device
+        @stage: stage model, see _conversion_units for supported values
+        @channel: channel that the controller object itself controls
+        @driver: module or object used to open the USB device; defaults to
+        d2xx, imported by open(), but can be a SimulatedD2XX to work without
+        hardware
+        """
+        APTAxis.__init__(self, self, channel, stage)
+        self._default_channel = channel
+        self._driver = driver
+        self._dev = None
+        self._real_serial_number = serial_number
+        self._axes = {}
+
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._moves = {}  # (source, channel) -> (message ID, future, axis)
+        self._waiters = {}  # message ID -> list of (source, channel, future)
+        self._subscribers = {}  # message ID -> list of callbacks
+        self._reader = None
+        self._reading = False
+        self._trace_name = None  # instrument name if the I/O is traced
+        self.reply_timeout = 5.0  # seconds
+
     ### CONTEXT MANAGER PROTOCOL ###
 
     def open(self):
-        self._dev = d2xx.openEx(self._real_serial_number)
+        for axis in self._all_axes():
+            axis.invalidate_parameters()
+        driver = self._driver
+        if driver is None:
+            _load_driver()
+            driver = d2xx
+        device = driver.openEx(self._real_serial_number)
+        # The reader thread polls the device, and records the packets it
+        # receives under their message IDs itself
+        name = 'APTController {0}'.format(self._real_serial_number)
+        self._dev = trace.wrap(device, name, key=_message_name,
+            untraced=('read', 'getStatus'))
+        self._trace_name = name if self._dev is not device else None
 
         # Recommended setup from Thorlabs APT Programming Guide
-        self._dev.setBaudRate(d2xx.BAUD_115200)
-        self._dev.setDataCharacteristics(d2xx.BITS_8, d2xx.STOP_BITS_1,
-            d2xx.PARITY_NONE)
+        self._dev.setBaudRate(driver.BAUD_115200)
+        self._dev.setDataCharacteristics(driver.BITS_8, driver.STOP_BITS_1,
+            driver.PARITY_NONE)
         time.sleep(50e-3)  # Wait 50 ms before and after purge
         self._dev.purge()  # Clear I/O queue
         time.sleep(50e-3)
         self._dev.resetDevice()
         self._dev.setRts()  # Assert the request-to-send line
 
+        # Let reads return regularly, so that the reader thread can stop
+        self._dev.setTimeouts(100, 100)
+        self._reading = True
+        self._reader = threading.Thread(target=self._read_packets,
+            name='APT packet reader')
+        self._reader.daemon = True
+        self._reader.start()
+
+        # The motherboard itself has no motor channels, so address the bay of
+        # the default channel instead
+        if self.hardware_type == 45:
+            self._address = 0x20 + self._default_channel
+            self._channel_num = 1
+        else:
+            self._address = 0x50
+            self._channel_num = self._default_channel
+        self._reply_source = None if self._address == 0x50 else self._address
+
     def close(self):
+        for axis in self._all_axes():
+            axis.stop_fly_scan()
+        self._reading = False
+        if self._reader is not None:
+            self._reader.join()
+            self._reader = None
         self._dev.close()
+        self._fail_all(IOError('Device closed'))
 
     def __enter__(self):
         self.open()
@@ -61,37 +549,211 @@ class APTController(object):
         self.close()
         return False  # don't suppress exceptions
 
+    ### AXES ###
+
+    def axis(self, channel, stage=None, address=None):
+        """
+        Get the axis object for @channel, which shares this controller's
+        connection. @stage defaults to the controller's stage model. If
+        @address is not given, it is chosen based on the hardware type: bays
+        0x21, 0x22, ... (each with channel number 1) on a multi-channel
+        controller motherboard, or channels 1, 2, ... on the controller itself.
+        """
+        if stage is None:
+            stage = self._stage_model
+        if address is None:
+            address = 0x20 + channel if self.hardware_type == 45 else 0x50
+        chan = 1 if address != 0x50 else channel
+        if address == self._address and chan == self._channel_num:
+            return self
+        try:
+            return self._axes[address, chan]
+        except KeyError:
+            axis = APTAxis(self, chan, stage, address)
+            self._axes[address, chan] = axis
+            return axis
+
+    def _all_axes(self):
+        return [self] + self._axes.values()
+
     ### COMMUNICATIONS ###
 
-    def _send_packet(self, msgid, param=(0, 0), data=None, dest=0x50, source=1):
+    def _write_packet(self, msgid, param=(0, 0), data=None, dest=0x50,
+        source=1):
         if data is None:
             packet = struct.pack('<HBBBB',
                 msgid, param[0], param[1], dest, source)
-            self._dev.write(packet)
         else:
-            packet = struct.pack('<HHBB', msgid, len(data), dest | 0x80, source)
+            packet = struct.pack('<HHBB', msgid, len(data), dest | 0x80,
+                source) + data
+        with self._write_lock:
             self._dev.write(packet)
-            self._dev.write(data)
-
-    def _read_packet(self, expected_msgid):
-        header = self._dev.read(6)
-        #print map(hex, map(ord, header))
-        msgid, length, dest, source = struct.unpack('<HHBB', header)
-        if msgid != expected_msgid:
-            raise IOError('Expected message ID {:04X}, '
-                'but received {:04X}'.format(expected_msgid, msgid))
-        if dest & 0x80:
-            return self._dev.read(length)
+
+    def _read_packets(self):
+        """
+        Reader thread: split the incoming byte stream into packets and
+        dispatch each one to the request or subscriber waiting for it.
+        """
+        buf = ''
+        try:
+            while self._reading:
+                rx_queue_length, _, _ = self._dev.getStatus()
+                start = trace.clock()
+                buf += self._dev.read(max(rx_queue_length, 1))
+                end = trace.clock()
+                while len(buf) >= 6:
+                    msgid, length, dest, source = struct.unpack_from('<HHBB',
+                        buf)
+                    if dest & 0x7F != 0x01 or \
+                        (source != 0x50 and not 0x11 <= source <= 0x2F):
+                        # Not addressed from a controller module to us, so we
+                        # are out of step with the packet boundaries; this
+                        # happens for example after
+                        # MGMSG_MOD_SET_CHANENABLESTATE, which is followed by a
+                        # spurious 0 byte. Skip a byte and try again.
+                        buf = buf[1:]
+                        continue
+                    if dest & 0x80:
+                        if len(buf) < 6 + length:
+                            break
+                        packet, buf = buf[:6 + length], buf[6 + length:]
+                        payload = packet[6:]
+                    else:
+                        packet, buf = buf[:6], buf[6:]
+                        payload = (length & 0xFF, length >> 8)
+                    if self._trace_name is not None:
+                        # Timed by the read that completed the packet
+                        trace.record(self._trace_name, 'read', None, packet,
+                            start, end, _message_name(packet))
+                    self._dispatch(msgid, source, payload)
+        except Exception as e:
+            self._fail_all(e)
+
+    def _dispatch(self, msgid, source, payload):
+        if isinstance(payload, tuple):
+            chan = payload[0]
+        elif len(payload) >= 2:
+            chan = struct.unpack_from('<H', payload)[0]
         else:
-            param1 = length & 0xFF
-            param2 = (length >> 0xFF) & 0xFF
-            return param1, param2
+            chan = None
+
+        if self._dispatch_move_message(msgid, source, chan, payload):
+            return
+        with self._lock:
+            waiters = self._waiters.get(msgid, [])
+            for waiter in waiters:
+                want_source, want_chan, future = waiter
+                if want_source in (None, source) and want_chan in (None, chan):
+                    waiters.remove(waiter)
+                    break
+            else:
+                future = None
+            subscribers = list(self._subscribers.get(msgid, []))
+        if future is not None:
+            future.set_result(payload)
+        for callback in subscribers:
+            callback(msgid, source, chan, payload)
+
+    def _fail_all(self, exception):
+        with self._lock:
+            moves, self._moves = self._moves, {}
+            waiters, self._waiters = self._waiters, {}
+        for _, future, _ in moves.values():
+            future.set_exception(exception)
+        for waiter_list in waiters.values():
+            for _, _, future in waiter_list:
+                future.set_exception(exception)
+
+    def _expect(self, msgid, chan=None, source=None):
+        """
+        Return a future that finishes with the payload of the next message
+        @msgid for channel @chan from module @source (None matches any). The
+        payload is the data string, or a tuple of the two parameter bytes for
+        header-only messages. Call this before sending the request, so that the
+        reply can't be missed.
+        """
+        future = Future()
+        with self._lock:
+            self._waiters.setdefault(msgid, []).append((source, chan, future))
+        return future
+
+    def _transact(self, msgid, reply_msgid, param=(0, 0), data=None,
+        dest=0x50, chan=None, source=None):
+        """Send a request and wait for the reply's payload."""
+        reply = self._expect(reply_msgid, chan, source)
+        self._write_packet(msgid, param, data, dest)
+        try:
+            return reply.result(self.reply_timeout)
+        except TimeoutError:
+            with self._lock:
+                waiters = self._waiters.get(reply_msgid, [])
+                waiters[:] = [w for w in waiters if w[2] is not reply]
+            raise IOError('No reply {:04X} to message {:04X} within '
+                '{} s'.format(reply_msgid, msgid, self.reply_timeout))
+
+    def subscribe(self, msgid, callback):
+        """
+        Call @callback(msgid, source, channel, payload) from the reader thread
+        for every message @msgid that the controller sends. Use this for
+        unsolicited messages such as status updates. The callback must not
+        block.
+        """
+        with self._lock:
+            self._subscribers.setdefault(msgid, []).append(callback)
+
+    def unsubscribe(self, msgid, callback):
+        with self._lock:
+            self._subscribers[msgid].remove(callback)
+
+    ### BACKGROUND MOVES ###
+
+    def _register_move(self, axis, completion_msgid, future):
+        key = (axis._reply_source, axis._channel_num)
+        with self._lock:
+            if key in self._moves:
+                raise IOError('Channel {} is already '
+                    'moving'.format(axis._channel_num))
+            self._moves[key] = (completion_msgid, future, axis)
+
+    def _pending_move(self, axis):
+        with self._lock:
+            move = self._moves.get((axis._reply_source, axis._channel_num))
+        return None if move is None else move[1]
+
+    def _dispatch_move_message(self, msgid, source, chan, payload):
+        """
+        Finish the pending move that the message @msgid belongs to. Returns
+        False if the message isn't a move completion message, or no move is
+        waiting for it.
+        """
+        if msgid not in (0x0464, 0x0444, 0x0466):
+            # MGMSG_MOT_MOVE_COMPLETED, MGMSG_MOT_MOVE_HOMED,
+            # MGMSG_MOT_MOVE_STOPPED
+            return False
+        with self._lock:
+            for key in ((source, chan), (None, chan)):
+                move = self._moves.get(key)
+                if move is not None and msgid in (move[0], 0x0466):
+                    del self._moves[key]
+                    break
+            else:
+                return False
+        _, future, axis = move
+        if msgid == 0x0466:
+            future.set_cancelled()
+        elif isinstance(payload, tuple):
+            future.set_result(None)
+        else:
+            # Status data: channel, position, encoder count, status bits
+            pos_counts = struct.unpack_from('<i', payload, 2)[0]
+            future.set_result(pos_counts / axis._position_units)
+        return True
 
     ### PROPERTIES ###
 
     def _get_hardware_info(self):
-        self._send_packet(0x0005)  # MGMSG_HW_REQ_INFO
-        data = self._read_packet(0x0006)  # MGMSG_HW_GET_INFO
+        data = self._transact(0x0005, 0x0006)
+        # MGMSG_HW_REQ_INFO, MGMSG_HW_GET_INFO
         (serial_number, model_number, hw_type, minor_ver, interim_ver,
             major_ver, _, notes, _, hw_ver, hw_mod_state, n_channels) = \
             struct.unpack('<L8sHBBBB48s12sHHH', data)
@@ -139,140 +801,80 @@ class APTController(object):
         However, it doesn't seem to be confined to those two values.
         """)
 
-    @property
-    def channel_enabled(self):
-        #if self._channel_num > self.n_channels:
-        #    raise ValueError('Invalid channel number {}'.self._channel_num)
-        self._send_packet(0x0211, param=(self._channel_num, 0))
-        # MGMSG_MOD_REQ_CHANENABLESTATE
-        chan, state = self._read_packet(0x0212)  # MGMSG_MOD_GET_CHANENABLESTATE
-        if chan != self._channel_num:
-            raise IOError('Requested state of channel {}, '
-                'but device returned channel {}'.format(
-                    self._channel_num, chan))
-        if state in (0, 1):  # apparently 0 is valid as well?!
-            return True
-        elif state == 2:
-            return False
-        else:
-            raise IOError('Device returned invalid state {}'.format(state))
-
-    @channel_enabled.setter
-    def channel_enabled(self, value):
-        state = (2, 1)[int(bool(value))]
-        self._send_packet(0x0210, param=(self._channel_num, state))
-        # MGMSG_MOD_SET_CHANENABLESTATE
-
-        # A spurious 0 byte is placed in the queue??
-        rx_queue_length, _, _ = self._dev.getStatus()
-        if rx_queue_length == 1:
-            garbage = ord(self._dev.read(1))
-            print 'Spurious byte {:02X}'.format(garbage)
-
-    def _get_velocity_parameters(self):
-        self._send_packet(0x0414, param=(self._channel_num, 0))
-        # MGMSG_MOT_REQ_VELPARAMS
-        data = self._read_packet(0x0415)  # MGMSG_MOT_GET_VELPARAMS
-        chan, _, accel_counts, max_velocity_counts = struct.unpack('<HIII',
-            data)
-        if chan != self._channel_num:
-            raise IOError('Requested state of channel {}, '
-                'but device returned channel {}'.format(
-                    self._channel_num, chan))
-        self._accel_counts = accel_counts
-        self._max_velocity_counts = max_velocity_counts
-
-    @property
-    def acceleration(self):
-        """Acceleration in mm/s^2."""
-        self._get_velocity_parameters()
-        return self._accel_counts / self._acceleration_units
-
-    @acceleration.setter
-    def acceleration(self, value):
-        self._get_velocity_parameters()
-        data = struct.pack('<HIII', self._channel_num, 0,
-            int(value * self._acceleration_units),
-            self._max_velocity_counts)
-        self._send_packet(0x0413, data=data)  # MGMSG_MOT_SET_VELPARAMS
-
-    @property
-    def max_velocity(self):
-        """Maximum velocity in mm/s."""
-        self._get_velocity_parameters()
-        return self._max_velocity_counts / self._velocity_units
-
-    @max_velocity.setter
-    def max_velocity(self, value):
-        self._get_velocity_parameters()
-        data = struct.pack('<HIII', self._channel_num, 0,
-            self._accel_counts,
-            int(value * self._velocity_units))
-        self._send_packet(0x0413, data=data)  # MGMSG_MOT_SET_VELPARAMS
+    ### PUBLIC METHODS ###
 
-    @property
-    def position(self):
+    def identify_yourself(self):
         """
-        Position in mm. Note that assigning to this property doesn't move the
-        stage, it only resets the position counter to that value while keeping
-        the stage in the same place.
+        Identify the controller by telling it to flash its front panel LED.
         """
-        self._send_packet(0x0411, param=(self._channel_num, 0))
-        # MGMSG_MOT_REQ_POSCOUNTER
-        data = self._read_packet(0x0412)  # MGMSG_MOT_GET_POSCOUNTER
-        chan, pos = struct.unpack('<Hi', data)
-        if chan != self._channel_num:
-            raise IOError('Requested state of channel {}, '
-                'but device returned channel {}'.format(
-                    self._channel_num, chan))
-        return pos / self._position_units
+        self._write_packet(0x0223)  # MGMSG_MOD_IDENTIFY
 
-    @position.setter
-    def position(self, value):
-        pos_counts = value * self._position_units
-        data = struct.pack('<Hi', self._channel_num, pos_counts)
-        self._send_packet(0x0410, data=data)  # MGMSG_MOT_SET_POSCOUNTER
 
-    ### PUBLIC METHODS ###
+class APTAxisGroup(object):
+    """
+    Several axes, on the same or on different controllers, that move
+    together. Moves are started on all axes at once, and then waited for
+    together, so that the axes move simultaneously.
+    """
 
-    def identify_yourself(self):
+    def __init__(self, axes):
+        self.axes = list(axes)
+
+    def _wait(self, futures, timeout):
+        try:
+            return wait_all(futures, timeout)
+        except:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def move_absolute_async(self, positions):
         """
-        Identify the controller by telling it to flash its front panel LED.
+        Start moving each axis to the corresponding element of @positions
+        (in mm), and return a list of Futures.
         """
-        self._send_packet(0x0223)  # MGMSG_MOD_IDENTIFY
+        return [axis.move_absolute_async(position)
+            for axis, position in zip(self.axes, positions)]
 
-    def move_relative(self, distance):
+    def move_absolute(self, positions, timeout=None):
         """
-        Initiate a relative move (distance given in mm) and wait for it to
-        finish.
+        Move each axis to the corresponding element of @positions (in mm) and
+        wait until all of them are done. If they aren't done within @timeout
+        seconds, all axes are stopped and TimeoutError is raised. Returns a
+        list of the final positions.
         """
-        distance_counts = distance * self._position_units
-        data = struct.pack('<Hi', self._channel_num, distance_counts)
-        self._send_packet(0x0445, data=data)  # MGMSG_MOT_SET_MOVERELPARAMS
-        self._send_packet(0x0448, param=(self._channel_num, 0))
-        # MGMSG_MOT_MOVE_RELATIVE
-        self._read_packet(0x0464)  # MGMSG_MOT_MOVE_COMPLETED, ignore status
+        return self._wait(self.move_absolute_async(positions), timeout)
 
-    def move_absolute(self, position):
+    def move_relative_async(self, distances):
         """
-        Initiate an absolute move (position given in mm) and wait for it to
-        finish. The position is relative to the current zero position, which can
-        be set by assigning to the `position` property.
+        Start moving each axis by the corresponding element of @distances
+        (in mm), and return a list of Futures.
         """
-        position_counts = position * self._position_units
-        data = struct.pack('<Hi', self._channel_num, position_counts)
-        self._send_packet(0x0450, data=data)  # MGMSG_MOT_SET_MOVEABSPARAMS
-        self._send_packet(0x0453, param=(self._channel_num, 0))
-        # MGMSG_MOT_MOVE_ABSOLUTE
-        self._read_packet(0x0464)  # MGMSG_MOT_MOVE_COMPLETED, ignore status
+        return [axis.move_relative_async(distance)
+            for axis, distance in zip(self.axes, distances)]
 
-    def move_home(self):
+    def move_relative(self, distances, timeout=None):
         """
-        Initiate a homing sequence and wait for it to finish.
+        Move each axis by the corresponding element of @distances (in mm) and
+        wait until all of them are done.
         """
-        self._send_packet(0x0443, param=(self._channel_num, 0))
-        # MGMSG_MOT_MOVE_HOME
-        self._read_packet(0x0444)  # MGMSG_MOT_MOVE_HOMED, ignore status
+        return self._wait(self.move_relative_async(distances), timeout)
+
+    def move_home_async(self):
+        return [axis.move_home_async() for axis in self.axes]
+
+    def move_home(self, timeout=None):
+        """Home all axes at once and wait until all of them are done."""
+        return self._wait(self.move_home_async(), timeout)
+
+    def stop(self, immediate=False):
+        for axis in self.axes:
+            axis.stop(immediate)
+
+    @property
+    def positions(self):
+        """List of the positions of all axes in mm."""
+        return [axis.position for axis in self.axes]
 
 if __name__ == '__main__':
     with APTController('83823336', stage='Z825B') as dev:
@@ -0,0 +1,403 @@
+import time
+import heapq
+import struct
+import threading
+
+from .apt_controller import _conversion_units
+
+__all__ = ['SimulatedD2XX', 'SimulatedAPTDevice', 'trapezoidal_move_time']
+
+
+def trapezoidal_move_time(distance, max_velocity, acceleration):
+    '''
+    Time in seconds for a move over @distance (mm) with a trapezoidal velocity
+    profile, accelerating and decelerating at @acceleration (mm/s^2) and
+    cruising at @max_velocity (mm/s).
+    '''
+    distance = abs(distance)
+    if distance == 0:
+        return 0.0
+    if distance < max_velocity ** 2 / acceleration:
+        # Triangular profile: never reaches full speed
+        return 2.0 * (distance / acceleration) ** 0.5
+    return distance / max_velocity + max_velocity / acceleration
+
+
+class _Channel(object):
+    '''State of one simulated motor channel, in counts.'''
+
+    def __init__(self):
+        self.enabled = True
+        self.homed = False
+        self.position = 0
+        self.rel_distance = 0
+        self.abs_position = 0
+        self.min_velocity = 0
+        self.acceleration = 0
+        self.max_velocity = 0
+        self.jog_params = (2, 0, 0, 0, 0, 2)  # single step, profiled stop
+        self.backlash = 0
+        # Current move: (start time, start position, end time, end position,
+        # completion message ID), or None
+        self.move = None
+        self.completion = None  # scheduled completion event
+
+    def position_at(self, now):
+        if self.move is None:
+            return self.position
+        t0, p0, t1, p1, _ = self.move
+        if now >= t1 or t1 == t0:
+            return p1
+        return int(p0 + (p1 - p0) * (now - t0) / (t1 - t0))
+
+
+class SimulatedAPTDevice(object):
+    '''
+    Software model of an APT motion controller, with the interface of a d2xx
+    device object. It speaks the binary APT protocol for hardware info,
+    channel enable state, velocity, jog and move parameters, position
+    counters, moves, stops and status updates. Moves take the time given by
+    a motion-time model, during which the position changes linearly.
+    '''
+
+    def __init__(self, serial_number, stage='MLS203', n_channels=1,
+        hardware_type=44, model_number='BBD101', motion_time=None,
+        time_scale=1.0, reply_latency=0.0, update_interval=0.1,
+        spurious_byte=True):
+        """
+        @stage: stage model, used to convert velocity and acceleration counts
+        @n_channels: number of motor channels
+        @hardware_type: 44 for a single controller, whose channels are
+        addressed as 0x50, or 45 for a motherboard with one channel per bay,
+        addressed as 0x21, 0x22, ...
+        @motion_time: function (distance, max_velocity, acceleration) -> time
+        in seconds, with arguments in mm, mm/s and mm/s^2; defaults to
+        trapezoidal_move_time()
+        @time_scale: factor applied to all move times, e.g. 0.01 to run scans
+        a hundred times faster than the real stage
+        @reply_latency: time in seconds before replies are available
+        @update_interval: time in seconds between status update messages
+        @spurious_byte: whether to imitate the extra 0 byte that real
+        controllers send after MGMSG_MOD_SET_CHANENABLESTATE
+        """
+        self.serial_number = serial_number
+        self._units = _conversion_units[stage]
+        self._n_channels = n_channels
+        self._hardware_type = hardware_type
+        self._model_number = model_number
+        self.motion_time = motion_time or trapezoidal_move_time
+        self.time_scale = time_scale
+        self.reply_latency = reply_latency
+        self.update_interval = update_interval
+        self.spurious_byte = spurious_byte
+
+        if hardware_type == 45:
+            self._addresses = [0x21 + bay for bay in range(n_channels)]
+            self._channels = dict(((address, 1), _Channel())
+                for address in self._addresses)
+        else:
+            self._addresses = [0x50]
+            self._channels = dict(((0x50, chan), _Channel())
+                for chan in range(1, n_channels + 1))
+        for channel in self._channels.values():
+            # Sensible defaults: 10 mm/s^2 and 2 mm/s
+            channel.acceleration = int(10 * self._units[2])
+            channel.max_velocity = int(2 * self._units[1])
+
+        self._condition = threading.Condition()
+        self._rx = ''  # bytes waiting to be read by the host
+        self._tx = ''  # bytes written by the host, not parsed yet
+        self._read_timeout = None
+        self._events = []  # heap of (time, sequence number, callback)
+        self._event_count = 0
+        self._updates = False
+        self._is_open = False
+        self._thread = None
+
+        # Statistics, useful when benchmarking
+        self.packets_received = 0
+        self.packets_sent = 0
+
+    ### D2XX DEVICE INTERFACE ###
+
+    def _open(self):
+        with self._condition:
+            self._is_open = True
+            self._rx = self._tx = ''
+        self._thread = threading.Thread(target=self._run_events,
+            name='Simulated APT device')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        with self._condition:
+            self._is_open = False
+            self._updates = False
+            self._condition.notify_all()
+        self._thread.join()
+
+    def setBaudRate(self, baud_rate):
+        pass
+
+    def setDataCharacteristics(self, bits, stop_bits, parity):
+        pass
+
+    def setRts(self):
+        pass
+
+    def resetDevice(self):
+        pass
+
+    def purge(self, mask=0):
+        with self._condition:
+            self._rx = self._tx = ''
+
+    def setTimeouts(self, read_timeout, write_timeout):
+        self._read_timeout = read_timeout / 1000.0
+
+    def getStatus(self):
+        with self._condition:
+            return len(self._rx), 0, 0
+
+    def read(self, n_bytes):
+        with self._condition:
+            deadline = None
+            if self._read_timeout is not None:
+                deadline = time.time() + self._read_timeout
+            while len(self._rx) < n_bytes and self._is_open:
+                if deadline is None:
+                    self._condition.wait(1.0)
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            data, self._rx = self._rx[:n_bytes], self._rx[n_bytes:]
+            return data
+
+    def write(self, data):
+        with self._condition:
+            self._tx += data
+            while len(self._tx) >= 6:
+                msgid, length, dest, source = struct.unpack_from('<HHBB',
+                    self._tx)
+                if dest & 0x80:
+                    if len(self._tx) < 6 + length:
+                        break
+                    payload = self._tx[6:6 + length]
+                    self._tx = self._tx[6 + length:]
+                else:
+                    payload = (length & 0xFF, length >> 8)
+                    self._tx = self._tx[6:]
+                self.packets_received += 1
+                self._handle(msgid, dest & 0x7F, payload)
+        return len(data)
+
+    ### EVENTS ###
+
+    def _schedule(self, delay, callback):
+        '''Must be called with the condition held.'''
+        self._event_count += 1
+        event = [time.time() + delay, self._event_count, callback]
+        heapq.heappush(self._events, event)
+        self._condition.notify_all()
+        return event
+
+    def _cancel(self, event):
+        event[2] = None
+
+    def _run_events(self):
+        with self._condition:
+            while self._is_open:
+                now = time.time()
+                while self._events and self._events[0][0] <= now:
+                    _, _, callback = heapq.heappop(self._events)
+                    if callback is not None:
+                        callback()
+                timeout = 1.0
+                if self._events:
+                    timeout = min(timeout, self._events[0][0] - now)
+                self._condition.wait(timeout)
+            self._events = []
+
+    def _reply(self, msgid, source, param=(0, 0), data=None):
+        '''Queue a reply for the host. Must be called with the condition held.'''
+        if data is None:
+            packet = struct.pack('<HBBBB', msgid, param[0], param[1], 0x01,
+                source)
+        else:
+            packet = struct.pack('<HHBB', msgid, len(data), 0x81,
+                source) + data
+
+        def deliver():
+            self._rx += packet
+            self.packets_sent += 1
+            self._condition.notify_all()
+        if self.reply_latency > 0:
+            self._schedule(self.reply_latency, deliver)
+        else:
+            deliver()
+
+    ### PROTOCOL ###
+
+    def _status(self, channel, now):
+        position = channel.position_at(now)
+        bits = 0
+        if channel.move is not None:
+            bits |= 0x10 if channel.move[3] >= channel.move[1] else 0x20
+        if channel.homed:
+            bits |= 0x400
+        if channel.enabled:
+            bits |= 0x80000000
+        return position, bits
+
+    def _status_data(self, chan, channel):
+        position, bits = self._status(channel, time.time())
+        return struct.pack('<HiiI', chan, position, position, bits)
+
+    def _handle(self, msgid, dest, payload):
+        if isinstance(payload, tuple):
+            chan = payload[0]
+        else:
+            chan = struct.unpack_from('<H', payload)[0]
+        if msgid == 0x0005:  # MGMSG_HW_REQ_INFO
+            data = struct.pack('<L8sHBBBB48s12sHHH',
+                int(self.serial_number), self._model_number,
+                self._hardware_type, 0, 0, 1, 0, 'Simulated APT controller',
+                '', 1, 0, self._n_channels)
+            self._reply(0x0006, dest, data=data)
+            return
+        if msgid == 0x0011:  # MGMSG_HW_START_UPDATEMSGS
+            if not self._updates:
+                self._updates = True
+                self._send_updates()
+            return
+        if msgid == 0x0012:  # MGMSG_HW_STOP_UPDATEMSGS
+            self._updates = False
+            return
+
+        channel = self._channels.get((dest, chan))
+        if channel is None:
+            return  # real controllers ignore messages they don't understand
+
+        if msgid == 0x0210:  # MGMSG_MOD_SET_CHANENABLESTATE
+            channel.enabled = payload[1] == 1
+            if self.spurious_byte:
+                self._rx += '\0'
+                self._condition.notify_all()
+        elif msgid == 0x0211:  # MGMSG_MOD_REQ_CHANENABLESTATE
+            self._reply(0x0212, dest, param=(chan, 1 if channel.enabled else 2))
+        elif msgid == 0x0413:  # MGMSG_MOT_SET_VELPARAMS
+            (_, channel.min_velocity, channel.acceleration,
+                channel.max_velocity) = struct.unpack('<HIII', payload)
+        elif msgid == 0x0414:  # MGMSG_MOT_REQ_VELPARAMS
+            self._reply(0x0415, dest, data=struct.pack('<HIII', chan,
+                channel.min_velocity, channel.acceleration,
+                channel.max_velocity))
+        elif msgid == 0x0416:  # MGMSG_MOT_SET_JOGPARAMS
+            channel.jog_params = struct.unpack('<HHiiiiH', payload)[1:]
+        elif msgid == 0x0417:  # MGMSG_MOT_REQ_JOGPARAMS
+            self._reply(0x0418, dest, data=struct.pack('<HHiiiiH', chan,
+                *channel.jog_params))
+        elif msgid == 0x043A:  # MGMSG_MOT_SET_GENMOVEPARAMS
+            channel.backlash = struct.unpack('<Hi', payload)[1]
+        elif msgid == 0x043B:  # MGMSG_MOT_REQ_GENMOVEPARAMS
+            self._reply(0x043C, dest, data=struct.pack('<Hi', chan,
+                channel.backlash))
+        elif msgid == 0x0410:  # MGMSG_MOT_SET_POSCOUNTER
+            channel.position = struct.unpack('<Hi', payload)[1]
+        elif msgid == 0x0411:  # MGMSG_MOT_REQ_POSCOUNTER
+            position, _ = self._status(channel, time.time())
+            self._reply(0x0412, dest, data=struct.pack('<Hi', chan, position))
+        elif msgid == 0x0445:  # MGMSG_MOT_SET_MOVERELPARAMS
+            channel.rel_distance = struct.unpack('<Hi', payload)[1]
+        elif msgid == 0x0450:  # MGMSG_MOT_SET_MOVEABSPARAMS
+            channel.abs_position = struct.unpack('<Hi', payload)[1]
+        elif msgid == 0x0448:  # MGMSG_MOT_MOVE_RELATIVE
+            start = channel.position_at(time.time())
+            self._start_move(dest, chan, channel,
+                start + channel.rel_distance, 0x0464)
+        elif msgid == 0x0453:  # MGMSG_MOT_MOVE_ABSOLUTE
+            self._start_move(dest, chan, channel, channel.abs_position, 0x0464)
+        elif msgid == 0x0443:  # MGMSG_MOT_MOVE_HOME
+            self._start_move(dest, chan, channel, 0, 0x0444)
+        elif msgid == 0x0465:  # MGMSG_MOT_MOVE_STOP
+            now = time.time()
+            channel.position = channel.position_at(now)
+            if channel.completion is not None:
+                self._cancel(channel.completion)
+                channel.completion = None
+            channel.move = None
+            self._reply(0x0466, dest, data=self._status_data(chan, channel))
+
+    def _start_move(self, dest, chan, channel, target, completion_msgid):
+        now = time.time()
+        start = channel.position_at(now)
+        if channel.completion is not None:
+            # A new move replaces the current one
+            self._cancel(channel.completion)
+        position_units, velocity_units, acceleration_units, _ = self._units
+        duration = self.time_scale * self.motion_time(
+            (target - start) / position_units,
+            channel.max_velocity / velocity_units,
+            channel.acceleration / acceleration_units)
+        channel.move = (now, start, now + duration, target, completion_msgid)
+
+        def complete():
+            channel.position = target
+            channel.move = None
+            channel.completion = None
+            if completion_msgid == 0x0444:  # MGMSG_MOT_MOVE_HOMED
+                channel.homed = True
+                self._reply(0x0444, dest, param=(chan, 0))
+            else:
+                self._reply(completion_msgid, dest,
+                    data=self._status_data(chan, channel))
+        channel.completion = self._schedule(duration, complete)
+
+    def _send_updates(self):
+        if not self._updates:
+            return
+        now = time.time()
+        for (address, chan), channel in sorted(self._channels.items()):
+            position, bits = self._status(channel, now)
+            velocity = 0
+            if channel.move is not None:
+                velocity = min(channel.max_velocity, 0xFFFF)
+            # MGMSG_MOT_GET_DCSTATUSUPDATE
+            self._reply(0x0491, address, data=struct.pack('<HiHHI', chan,
+                position, velocity, 0, bits))
+        self._schedule(self.update_interval, self._send_updates)
+
+
+class SimulatedD2XX(object):
+    '''
+    Stand-in for the d2xx module, which opens SimulatedAPTDevices instead of
+    real FTDI devices. Pass it to APTController as the driver argument:
+        driver = SimulatedD2XX(stage='MLS203', time_scale=0.1)
+        with APTController('83000001', 'MLS203', driver=driver) as stage:
+            stage.move_absolute(10.0)
+    Opening the same serial number again returns the same device, so the
+    simulated stage keeps its state between connections.
+    '''
+
+    BAUD_115200 = 115200
+    BITS_8 = 8
+    STOP_BITS_1 = 0
+    PARITY_NONE = 0
+
+    def __init__(self, **device_kwargs):
+        """
+        @device_kwargs: keyword arguments for SimulatedAPTDevice
+        """
+        self._device_kwargs = device_kwargs
+        self.devices = {}
+
+    def openEx(self, serial_number):
+        try:
+            device = self.devices[serial_number]
+        except KeyError:
+            device = SimulatedAPTDevice(serial_number, **self._device_kwargs)
+            self.devices[serial_number] = device
+        device._open()
+        return device
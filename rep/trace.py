@@ -0,0 +1,389 @@
+import re
+import json
+import bisect
+import threading
+import collections
+import timeit
+
+__all__ = ['Tracer', 'enable', 'disable', 'tracing', 'wrap', 'record',
+    'current_tracer', 'clock']
+
+# Latency histogram bins, four per decade from 1 us to 10 s
+_BIN_EDGES = [10 ** (exponent / 4.0) for exponent in range(-24, 5)]
+
+_NUMBER = re.compile(r'[-+]?\d+(\.\d*)?([eE][-+]?\d+)?')
+
+# Clock of the recorded start and end times
+clock = timeit.default_timer
+
+
+def command_key(data):
+    '''
+    Name under which a message is counted: text commands with their numbers
+    replaced by '#', so that e.g. '1PA10.0' and '2PA-5' are both '#PA#', or
+    the first byte in hex for binary messages.
+    '''
+    if not data:
+        return '(empty)'
+    text = data[:40].split(';')[0].strip()
+    if text and all(' ' <= char <= '~' for char in text):
+        return _NUMBER.sub('#', text.split(' ')[0])
+    return '0x{0:02x}'.format(ord(data[0]))
+
+
+class _Statistics(object):
+    def __init__(self):
+        self.count = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * (len(_BIN_EDGES) + 1)
+
+    def add(self, duration, bytes_out, bytes_in):
+        self.count += 1
+        self.bytes_out += bytes_out
+        self.bytes_in += bytes_in
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.histogram[bisect.bisect(_BIN_EDGES, duration)] += 1
+
+    def percentile(self, fraction):
+        '''Upper edge of the histogram bin that contains @fraction.'''
+        needed = fraction * self.count
+        total = 0
+        for index, count in enumerate(self.histogram):
+            total += count
+            if total >= needed and count:
+                if index == len(_BIN_EDGES):
+                    return self.max_time
+                return min(_BIN_EDGES[index], self.max_time)
+        return self.max_time
+
+
+class Tracer(object):
+    """
+    Records every I/O operation of the instruments while tracing is enabled:
+    per instrument and command, the number of operations, bytes sent and
+    received and a latency histogram, and a timeline of the last
+    @max_events operations for export as a Chrome trace.
+    """
+
+    def __init__(self, max_events=100000):
+        self._lock = threading.Lock()
+        self._start = clock()
+        self._statistics = {}  # (instrument, command) -> _Statistics
+        self._events = collections.deque(maxlen=max_events)
+        self._last_command = {}  # instrument -> command of the last write
+
+    def clear(self):
+        with self._lock:
+            self._start = clock()
+            self._statistics.clear()
+            self._events.clear()
+            self._last_command.clear()
+
+    def record(self, instrument, operation, data_out, data_in, start, end,
+            command=None):
+        '''
+        Record one I/O operation of @instrument. @operation is 'write',
+        'read', or the name of another call. Writes are counted under
+        @command, or by default command_key(@data_out); reads are counted
+        under @command if it is given, or else under the command of the last
+        write to the same instrument.
+        '''
+        with self._lock:
+            if operation == 'write':
+                if command is None:
+                    command = command_key(data_out)
+                self._last_command[instrument] = command
+            elif operation == 'read':
+                if command is None:
+                    command = self._last_command.get(instrument, '?')
+                command += ' (read)'
+            else:
+                command = operation
+            statistics = self._statistics.get((instrument, command))
+            if statistics is None:
+                statistics = _Statistics()
+                self._statistics[instrument, command] = statistics
+            bytes_out = len(data_out) if data_out else 0
+            bytes_in = len(data_in) if data_in else 0
+            statistics.add(end - start, bytes_out, bytes_in)
+            self._events.append((instrument, command, start, end,
+                threading.current_thread().name, bytes_out, bytes_in))
+
+    @property
+    def statistics(self):
+        '''
+        Dictionary of (instrument, command) -> dictionary with count,
+        bytes_out, bytes_in, total_time, mean_time, median_time, p99_time,
+        max_time (in seconds) and histogram (counts in the bins between
+        bin_edges).
+        '''
+        with self._lock:
+            return dict(((key, {
+                'count': s.count,
+                'bytes_out': s.bytes_out,
+                'bytes_in': s.bytes_in,
+                'total_time': s.total_time,
+                'mean_time': s.total_time / s.count,
+                'median_time': s.percentile(0.5),
+                'p99_time': s.percentile(0.99),
+                'max_time': s.max_time,
+                'histogram': list(s.histogram),
+            }) for key, s in self._statistics.items()))
+
+    bin_edges = _BIN_EDGES
+
+    def summary(self):
+        '''
+        Table of the statistics, one line per instrument and command, with
+        the commands that took the most time in total first. Median and 99th
+        percentile are estimated from the histogram.
+        '''
+        rows = sorted(self.statistics.items(),
+            key=lambda item: -item[1]['total_time'])
+        lines = ['{0:<24} {1:<24} {2:>7} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9} '
+            '{8:>9}'.format('instrument', 'command', 'count', 'out [B]',
+            'in [B]', 'total [s]', 'mean [ms]', 'p50 [ms]', 'p99 [ms]')]
+        for (instrument, command), s in rows:
+            lines.append('{0:<24} {1:<24} {2:>7} {3:>9} {4:>9} {5:>9.3f} '
+                '{6:>9.3f} {7:>9.3f} {8:>9.3f}'.format(instrument[:24],
+                command[:24], s['count'], s['bytes_out'], s['bytes_in'],
+                s['total_time'], s['mean_time'] * 1e3,
+                s['median_time'] * 1e3, s['p99_time'] * 1e3))
+        return '\n'.join(lines)
+
+    def chrome_trace(self, filename):
+        '''
+        Write the recorded timeline to @filename in the Chrome trace event
+        format, to be viewed in chrome://tracing. Each instrument is shown as
+        a separate process, with a row for each thread.
+        '''
+        with self._lock:
+            events = list(self._events)
+            start = self._start
+        instruments = sorted(set(event[0] for event in events))
+        pids = dict((instrument, pid)
+            for pid, instrument in enumerate(instruments, 1))
+        threads = sorted(set(event[4] for event in events))
+        tids = dict((thread, tid) for tid, thread in enumerate(threads, 1))
+
+        trace = []
+        for instrument, pid in pids.items():
+            trace.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                'args': {'name': instrument}})
+        for instrument, command, begin, end, thread, bytes_out, bytes_in \
+                in events:
+            trace.append({
+                'name': command,
+                'cat': 'io',
+                'ph': 'X',
+                'ts': (begin - start) * 1e6,
+                'dur': (end - begin) * 1e6,
+                'pid': pids[instrument],
+                'tid': tids[thread],
+                'args': {'bytes_out': bytes_out, 'bytes_in': bytes_in,
+                    'thread': thread},
+            })
+        with open(filename, 'w') as trace_file:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'},
+                trace_file)
+
+
+_tracer = None
+_patches = []  # (object, attribute name, original)
+_local = threading.local()
+
+
+def current_tracer():
+    '''The Tracer that records I/O, or None if tracing is disabled.'''
+    return _tracer
+
+
+def _traced_call(instrument, operation, func, args, data_out=None,
+        returns_data=False, command=None):
+    '''
+    Call @func(*args) and record it. Calls made while another traced call
+    is in progress in the same thread, such as the VISA library calls inside
+    an instrument's write(), are not recorded separately, and neither are
+    reads that return no data, such as a polling read that timed out.
+    '''
+    tracer = _tracer
+    if tracer is None or getattr(_local, 'busy', False):
+        return func(*args)
+    _local.busy = True
+    start = clock()
+    try:
+        result = func(*args)
+    finally:
+        end = clock()
+        _local.busy = False
+    data_in = result if returns_data and isinstance(result, str) else None
+    if returns_data and not data_in:
+        return result
+    tracer.record(instrument, operation, data_out, data_in, start, end,
+        command)
+    return result
+
+
+def _instrument_name(instrument):
+    resource_name = getattr(instrument, 'resource_name', None)
+    name = type(instrument).__name__
+    if resource_name:
+        return '{0} {1}'.format(name, resource_name)
+    return name
+
+
+def _patch(owner, name, replacement):
+    _patches.append((owner, name, owner.__dict__[name]))
+    setattr(owner, name, replacement)
+
+
+def _patch_visa():
+    try:
+        import visa
+        from pyvisa import vpp43
+    except ImportError:
+        return
+    instrument_class = getattr(visa, 'Instrument', None)
+    if instrument_class is not None:
+        write = instrument_class.__dict__.get('write')
+        read_raw = instrument_class.__dict__.get('read_raw')
+        if write is not None:
+            def traced_write(self, message):
+                return _traced_call(_instrument_name(self), 'write', write,
+                    (self, message), data_out=message)
+            _patch(instrument_class, 'write', traced_write)
+        if read_raw is not None:
+            def traced_read_raw(self, *args):
+                return _traced_call(_instrument_name(self), 'read', read_raw,
+                    (self,) + args, returns_data=True)
+            _patch(instrument_class, 'read_raw', traced_read_raw)
+
+    # Ocean Optics spectrometers use the VISA library directly
+    vpp43_write = vpp43.write
+    vpp43_read = vpp43.read
+
+    def traced_vpp43_write(vi, message):
+        return _traced_call('VISA session {0}'.format(vi), 'write',
+            vpp43_write, (vi, message), data_out=message)
+
+    def traced_vpp43_read(vi, count):
+        return _traced_call('VISA session {0}'.format(vi), 'read',
+            vpp43_read, (vi, count), returns_data=True)
+    _patch(vpp43, 'write', traced_vpp43_write)
+    _patch(vpp43, 'read', traced_vpp43_read)
+
+
+def enable(tracer=None):
+    '''
+    Start tracing the I/O of all instruments into @tracer, or a new Tracer,
+    and return the tracer. VISA instruments (such as ESP300, Oscilloscope,
+    TempStage, HP33120A and MillenniaPro) and the VISA library calls of the
+    Ocean Optics spectrometers are traced as soon as tracing is enabled;
+    devices passed through wrap(), such as the USB device of an
+    APTController and the COM objects of an AltaAscent, only if tracing was
+    enabled when they were opened.
+    '''
+    global _tracer
+    if tracer is None:
+        tracer = Tracer()
+    if _tracer is None:
+        _patch_visa()
+    _tracer = tracer
+    return tracer
+
+
+def disable():
+    '''Stop tracing. Returns the tracer that was used.'''
+    global _tracer
+    tracer = _tracer
+    _tracer = None
+    while _patches:
+        owner, name, original = _patches.pop()
+        setattr(owner, name, original)
+    return tracer
+
+
+class tracing(object):
+    '''
+    Context manager that traces the I/O in its block.
+        with rep.trace.tracing() as tracer:
+            scan.run()
+        print tracer.summary()
+    '''
+
+    def __init__(self, tracer=None):
+        self.tracer = tracer
+
+    def __enter__(self):
+        self.tracer = enable(self.tracer)
+        return self.tracer
+
+    def __exit__(self, *args):
+        disable()
+        return False
+
+
+def record(instrument, operation, data_out, data_in, start, end,
+        command=None):
+    '''
+    Record an I/O operation that the caller timed itself, with start and end
+    times from clock(), if tracing is enabled; see Tracer.record().
+    '''
+    tracer = _tracer
+    if tracer is not None:
+        tracer.record(instrument, operation, data_out, data_in, start, end,
+            command)
+
+
+class _TracedDevice(object):
+    '''Proxy that records the method calls of a device object.'''
+
+    def __init__(self, device, name, key, untraced):
+        self._device = device
+        self._name = name
+        self._key = key
+        self._untraced = untraced
+
+    def __getattr__(self, attribute):
+        value = getattr(self._device, attribute)
+        if not callable(value) or attribute in self._untraced:
+            return value
+        name = self._name
+        if attribute == 'write':
+            key = self._key
+
+            def traced(data, *args):
+                return _traced_call(name, 'write', value, (data,) + args,
+                    data_out=data, command=key(data) if key else None)
+        elif attribute == 'read':
+            def traced(*args):
+                return _traced_call(name, 'read', value, args,
+                    returns_data=True)
+        else:
+            def traced(*args):
+                return _traced_call(name, attribute, value, args)
+        return traced
+
+    def __setattr__(self, attribute, value):
+        if attribute.startswith('_'):
+            object.__setattr__(self, attribute, value)
+        else:
+            setattr(self._device, attribute, value)
+
+
+def wrap(device, name, key=None, untraced=()):
+    '''
+    Return @device wrapped so that its method calls are traced under the
+    instrument name @name, or @device itself if tracing is disabled. Writes
+    are counted per command, named by the function @key of the written data
+    (default: command_key()), for example to name binary packets. The
+    methods named in @untraced are not recorded, for example the polling of
+    a reader thread that records the messages it receives with record().
+    '''
+    if _tracer is None:
+        return device
+    return _TracedDevice(device, name, key, frozenset(untraced))